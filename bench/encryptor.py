@@ -0,0 +1,83 @@
+"""
+Per-message cost of building a cipher for every call versus reusing a cached one.
+
+    python -m bench.encryptor [--messages N] [--connections N]
+"""
+import argparse
+import asyncio
+import time
+
+from utils.encryptor import TextEncryptor, get_encryptor
+
+TEXT = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 4
+
+
+def bench(name: str, func, messages: int, repeat: int = 3) -> float:
+    elapsed = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = min(elapsed, time.perf_counter() - start)
+
+    per_message = elapsed / messages * 1_000_000
+    print(f"{name:<28} {elapsed * 1000:9.1f} ms  {per_message:8.2f} us/message")
+    return per_message
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--connections", type=int, default=100)
+    args = parser.parse_args()
+
+    keys = [f"connection-{i}" for i in range(args.connections)]
+    tokens = {key: TextEncryptor(key=key).encrypt(TEXT) for key in keys}
+
+    def uncached_encrypt():
+        for i in range(args.messages):
+            TextEncryptor(key=keys[i % len(keys)]).encrypt(TEXT)
+
+    def cached_encrypt():
+        for i in range(args.messages):
+            get_encryptor(keys[i % len(keys)]).encrypt(TEXT)
+
+    def uncached_decrypt():
+        for i in range(args.messages):
+            key = keys[i % len(keys)]
+            TextEncryptor(key=key).decrypt(tokens[key])
+
+    def cached_decrypt():
+        for i in range(args.messages):
+            key = keys[i % len(keys)]
+            get_encryptor(key).decrypt(tokens[key])
+
+    def batch_decrypt():
+        per_key = args.messages // len(keys)
+        for key in keys:
+            get_encryptor(key).decrypt_many([tokens[key]] * per_key)
+
+    def threaded_batch_decrypt():
+        per_key = args.messages // len(keys)
+
+        async def run():
+            await asyncio.gather(*(get_encryptor(key).decrypt_many_async([tokens[key]] * per_key, thread_batch_size=1)
+                                   for key in keys))
+
+        asyncio.run(run())
+
+    print(f"{args.messages} messages over {args.connections} connections\n")
+
+    before = bench("encrypt, new cipher", uncached_encrypt, args.messages)
+    after = bench("encrypt, cached cipher", cached_encrypt, args.messages)
+    print(f"{'saved':<28} {before - after:21.2f} us/message\n")
+
+    before = bench("decrypt, new cipher", uncached_decrypt, args.messages)
+    after = bench("decrypt, cached cipher", cached_decrypt, args.messages)
+    print(f"{'saved':<28} {before - after:21.2f} us/message\n")
+
+    bench("decrypt_many", batch_decrypt, args.messages)
+    bench("decrypt_many_async, threads", threaded_batch_decrypt, args.messages)
+
+
+if __name__ == "__main__":
+    main()
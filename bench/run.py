@@ -0,0 +1,305 @@
+"""
+Throughput and latency of the real dispatcher from main.py against SQLite with a stubbed Bot.
+
+Synthetic business updates are fed through Dispatcher.feed_update, every connection gets
+its own stream of new messages, edits and deletions of messages it stored before.
+
+    python -m bench.run [--updates N] [--connections N] [--mix text=50,media=15,...]
+                        [--buffer] [--json FILE] [--compare FILE]
+
+Mix kinds: text, media, sticker (new messages), edit, delete (one id), bulk (1 to --bulk-max ids).
+Run it from the repository root, like the bot itself.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import typing
+
+from aiogram.types import (Update, Message, Chat, User, BusinessConnection, BusinessMessagesDeleted, PhotoSize,
+                           Sticker)
+
+DEFAULT_MIX = "text=50,media=15,sticker=5,edit=20,delete=8,bulk=2"
+KINDS = ("text", "media", "sticker", "edit", "delete", "bulk")
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in KINDS:
+            raise argparse.ArgumentTypeError(f"Unknown update kind {kind!r}, expected one of {', '.join(KINDS)}")
+        weights[kind.strip()] = float(weight or 1)
+    return weights
+
+
+def write_config(path: str, database: str, buffer: bool) -> None:
+    with open(path, "w") as f:
+        f.write(f"""[BOT]
+token = 42:BENCH
+
+[DATABASE]
+username = bench
+password = bench
+ip = localhost
+port = 0
+db = bench
+dsn = sqlite+aiosqlite:///{database}
+
+[BUFFER]
+enabled = {buffer}
+
+[RETENTION]
+days = 0
+""")
+
+
+class Workload:
+    """Generates updates for `connections` business connections, each with its own peer"""
+
+    def __init__(self, connections: int, mix: dict[str, float], bulk_max: int, seed: int) -> None:
+        self.connections = connections
+        self.bulk_max = bulk_max
+
+        self._random = random.Random(seed)
+        self._kinds = list(mix)
+        self._weights = list(mix.values())
+        self._update_id = 0
+        self._message_id = [0] * connections
+        self._stored: list[dict[int, str]] = [{} for _ in range(connections)]  # message id -> kind
+
+    @staticmethod
+    def owner(index: int) -> User:
+        return User(id=1_000_000 + index, is_bot=False, first_name=f"Owner {index}", language_code="en")
+
+    @staticmethod
+    def peer(index: int) -> User:
+        return User(id=2_000_000 + index, is_bot=False, first_name=f"Peer {index}", username=f"peer{index}")
+
+    @staticmethod
+    def connection_id(index: int) -> str:
+        return f"bench-connection-{index}"
+
+    def _update(self, **kwargs) -> Update:
+        self._update_id += 1
+        return Update(update_id=self._update_id, **kwargs)
+
+    def connect(self, index: int) -> Update:
+        return self._update(business_connection=BusinessConnection(
+            id=self.connection_id(index), user=self.owner(index), user_chat_id=self.owner(index).id,
+            date=datetime.datetime.now(), can_reply=True, is_enabled=True))
+
+    def _message(self, index: int, message_id: int, kind: str, edited: bool = False) -> Message:
+        peer = self.peer(index)
+        content: dict[str, typing.Any] = {}
+        if kind == "text":
+            content["text"] = f"Message {message_id} " + "lorem ipsum dolor sit amet " * self._random.randint(1, 20)
+        elif kind == "media":
+            content["photo"] = [PhotoSize(file_id=f"photo-{index}-{message_id}", file_unique_id=f"p{index}-{message_id}",
+                                          width=1280, height=720)]
+            content["caption"] = f"Caption {message_id}"
+        else:
+            content["sticker"] = Sticker(file_id=f"sticker-{index}-{message_id}", file_unique_id=f"s{index}-{message_id}",
+                                         type="regular", width=512, height=512, is_animated=False, is_video=False)
+
+        return Message(message_id=message_id, date=datetime.datetime.now(),
+                       edit_date=int(time.time()) if edited else None,
+                       chat=Chat(id=peer.id, type="private", first_name=peer.first_name, username=peer.username),
+                       from_user=peer, business_connection_id=self.connection_id(index), **content)
+
+    def next(self) -> tuple[str, Update]:
+        index = self._random.randrange(self.connections)
+        stored = self._stored[index]
+        kind = self._random.choices(self._kinds, self._weights)[0]
+
+        # Edits and deletions need stored messages, a new message is sent instead
+        if kind in ("edit", "delete", "bulk") and not stored:
+            kind = "text"
+
+        if kind == "edit":
+            message_id = self._random.choice(list(stored))
+            return kind, self._update(edited_business_message=self._message(index, message_id, stored[message_id],
+                                                                            edited=True))
+
+        if kind in ("delete", "bulk"):
+            count = 1 if kind == "delete" else self._random.randint(1, self.bulk_max)
+            message_ids = self._random.sample(list(stored), min(count, len(stored)))
+            for message_id in message_ids:
+                del stored[message_id]
+
+            peer = self.peer(index)
+            return kind, self._update(deleted_business_messages=BusinessMessagesDeleted(
+                business_connection_id=self.connection_id(index),
+                chat=Chat(id=peer.id, type="private", first_name=peer.first_name, username=peer.username),
+                message_ids=message_ids))
+
+        self._message_id[index] += 1
+        message_id = self._message_id[index]
+        stored[message_id] = kind
+        return kind, self._update(business_message=self._message(index, message_id, kind))
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    if len(samples) < 2:
+        value = samples[0] if samples else 0.0
+        return dict(p50=value, p95=value, p99=value)
+
+    cuts = statistics.quantiles(samples, n=100)
+    return dict(p50=cuts[49], p95=cuts[94], p99=cuts[98])
+
+
+async def wait_idle(main) -> None:
+    while main.ordering.depth:
+        await asyncio.sleep(0.001)
+    if main.buffer is not None:
+        await main.buffer.flush()
+
+
+async def run(args: argparse.Namespace) -> dict:
+    import main
+    from sqlalchemy import event
+
+    from bench.stubs import create_stub_bot
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    latencies: dict[str, list[float]] = {kind: [] for kind in KINDS}
+    kinds: dict[int, str] = {}
+    queries = 0
+
+    @event.listens_for(main.db.engine.sync_engine, "before_cursor_execute")
+    def count_query(*_) -> None:
+        nonlocal queries
+        queries += 1
+
+    # Registered after OrderedDispatchMiddleware, so only the handling of an update is timed, not its wait in the queue
+    @main.dp.update.outer_middleware()
+    async def measure(handler, update: Update, data: dict) -> typing.Any:
+        start = time.perf_counter()
+        try:
+            return await handler(update, data)
+        finally:
+            kind = kinds.pop(update.update_id, None)
+            if kind is not None:
+                latencies[kind].append((time.perf_counter() - start) * 1000)
+
+    bot = create_stub_bot(latency_ms=args.api_latency_ms)
+    workload = Workload(connections=args.connections, mix=parse_mix(args.mix), bulk_max=args.bulk_max, seed=args.seed)
+
+    await main.db.create_tables()
+    await main.dp.emit_startup(bot=bot, dispatcher=main.dp, run_pruner=False)
+
+    try:
+        for index in range(args.connections):
+            await main.dp.feed_update(bot, workload.connect(index))
+        await wait_idle(main)
+
+        queries = 0
+        requests = bot.session.requests
+        shed = main.ordering.shed
+        counts = {kind: 0 for kind in KINDS}
+
+        start = time.perf_counter()
+        for _ in range(args.updates):
+            kind, update = workload.next()
+            kinds[update.update_id] = kind
+            counts[kind] += 1
+            await main.dp.feed_update(bot, update)
+        await wait_idle(main)
+        elapsed = time.perf_counter() - start
+    finally:
+        await main.dp.emit_shutdown(bot=bot, dispatcher=main.dp)
+        await main.db.close()
+
+    handled = [value for samples in latencies.values() for value in samples]
+    return dict(
+        updates=args.updates,
+        connections=args.connections,
+        mix=args.mix,
+        buffer=args.buffer,
+        api_latency_ms=args.api_latency_ms,
+        seconds=round(elapsed, 3),
+        updates_per_sec=round(args.updates / elapsed, 1),
+        latency_ms={name: round(value, 3) for name, value in percentiles(handled).items()},
+        queries_per_update=round(queries / args.updates, 3),
+        requests_per_update=round((bot.session.requests - requests) / args.updates, 3),
+        shed=main.ordering.shed - shed,
+        by_kind={
+            kind: dict(count=counts[kind],
+                       **{name: round(value, 3) for name, value in percentiles(latencies[kind]).items()})
+            for kind in KINDS if counts[kind]
+        },
+    )
+
+
+def print_report(report: dict, baseline: typing.Optional[dict] = None) -> None:
+    def change(value: float, key: typing.Callable[[dict], float]) -> str:
+        if baseline is None:
+            return ""
+        try:
+            old = key(baseline)
+        except KeyError:
+            return ""
+        return f"  ({(value - old) / old * 100:+.1f}%)" if old else ""
+
+    latency = report["latency_ms"]
+    print(f"{report['updates']} updates from {report['connections']} connections in {report['seconds']}s")
+    print(f"updates/sec        {report['updates_per_sec']:10.1f}{change(report['updates_per_sec'], lambda r: r['updates_per_sec'])}")
+    for name in ("p50", "p95", "p99"):
+        print(f"latency {name} ms     {latency[name]:10.3f}{change(latency[name], lambda r: r['latency_ms'][name])}")
+    print(f"queries/update     {report['queries_per_update']:10.3f}"
+          f"{change(report['queries_per_update'], lambda r: r['queries_per_update'])}")
+    print(f"requests/update    {report['requests_per_update']:10.3f}")
+    if report["shed"]:
+        print(f"dropped updates    {report['shed']:10d}")
+
+    print(f"\n{'kind':<10}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, stats in report["by_kind"].items():
+        print(f"{kind:<10}{stats['count']:>8}{stats['p50']:>10.3f}{stats['p95']:>10.3f}{stats['p99']:>10.3f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Weights of update kinds (default: {DEFAULT_MIX})")
+    parser.add_argument("--bulk-max", type=int, default=500, help="Largest number of ids in a bulk deletion")
+    parser.add_argument("--buffer", action="store_true", help="Enable the message write buffer")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="Delay of every stubbed Bot API request")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="FILE", help="Write the report as JSON ('-' for stdout)")
+    parser.add_argument("--compare", metavar="FILE", help="JSON report of a previous run to compare with")
+    args = parser.parse_args()
+    parse_mix(args.mix)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    with tempfile.TemporaryDirectory() as directory:
+        # utils.config reads the file named by CONFIG when main is imported
+        os.environ["CONFIG"] = os.path.join(directory, "config.ini")
+        write_config(os.environ["CONFIG"], database=os.path.join(directory, "bench.db"), buffer=args.buffer)
+
+        report = asyncio.run(run(args))
+
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report, baseline)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import asyncio
+import datetime
+import itertools
+import typing
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.enums import ParseMode
+from aiogram.methods import TelegramMethod, GetMe, SendMediaGroup
+from aiogram.types import Message, Chat, User
+
+
+class StubSession(BaseSession):
+    """Answers every request locally, optionally after `latency_ms` to imitate the network"""
+
+    def __init__(self, latency_ms: float = 0) -> None:
+        super().__init__()
+        self.latency_ms = latency_ms
+        self.requests = 0
+
+        self._ids = itertools.count(1)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: typing.Optional[int] = None) -> typing.Any:
+        self.requests += 1
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+
+        if isinstance(method, GetMe):
+            return User(id=bot.id, is_bot=True, first_name="Bench", username="bench_bot")
+
+        chat_id = getattr(method, "chat_id", None) or 1
+        message = Message(message_id=next(self._ids), date=datetime.datetime.now(),
+                          chat=Chat(id=chat_id, type="private"))
+
+        if isinstance(method, SendMediaGroup):
+            return [message for _ in method.media]
+        if method.__returning__ is Message:
+            return message
+        return True
+
+    async def stream_content(self, url: str, headers: typing.Optional[dict[str, typing.Any]] = None,
+                             timeout: int = 30, chunk_size: int = 65536,
+                             raise_for_status: bool = True) -> typing.AsyncGenerator[bytes, None]:
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+def create_stub_bot(latency_ms: float = 0) -> Bot:
+    """A bot that never reaches Telegram and has no rate limiter, so only the bot itself is measured"""
+    return Bot(token="42:BENCH", session=StubSession(latency_ms=latency_ms), parse_mode=ParseMode.HTML)
@@ -1,52 +1,143 @@
-import asyncio
 import logging
+import typing
 
 from aiogram import Router, Bot
+from aiogram.dispatcher.event.bases import SkipHandler
 from aiogram.enums import ContentType
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import BusinessMessagesDeleted
 from aiogram.utils.i18n import gettext as _
+from aiogram.utils.media_group import MediaGroupBuilder, MAX_MEDIA_GROUP_SIZE
 
 from filters.ContentTypeFilter import ContentTypeFilter
+from middlewares.rate_limit import BulkPriorityMiddleware
+from middlewares.stored_messages import StoredMessages
 from repo import Repo
-from utils.encryptor import get_text_hash, TextEncryptor
+from repo.media import MediaStore
+from repo.modules.messages import MessageData
+from repo.modules.users import UserData
+from utils.digest import DeletionDigest
+from utils.encryptor import get_text_hash, get_encryptor
 
 message_delete_route = Router()
+# Single deletions are notified at normal priority, bulk ones and their digests after them
+message_delete_route.deleted_business_messages.middleware(BulkPriorityMiddleware())
+
+# Telegram only groups photos with videos, documents with documents and audio with audio
+ALBUMS = {
+    ContentType.PHOTO: "visual",
+    ContentType.VIDEO: "visual",
+    ContentType.DOCUMENT: ContentType.DOCUMENT,
+    ContentType.AUDIO: ContentType.AUDIO,
+}
+
+
+async def take_messages(repo: Repo, stored_messages: StoredMessages, messages: list[MessageData]) -> None:
+    """
+    Deletes the messages a handler got from ContentTypeFilter and marks them handled.
+
+    Handlers commit once they are done with the database, before sending notifications: sending is
+    rate limited, and the connection and the locks of the deleted rows are not held meanwhile.
+    """
+    stored_messages.handle(messages)
+    await repo.messages.delete_many(connection_id=stored_messages.connection_id,
+                                    message_ids=[m.message_id for m in messages])
+
+    # Only edited messages have versions
+    edited = [m.message_id for m in messages if m.version]
+    if edited:
+        await repo.versions.delete_many(connection_id=stored_messages.connection_id, message_ids=edited)
+
+
+def pass_on(stored_messages: StoredMessages) -> None:
+    """Lets the next handlers take the messages of other types from a mixed batch"""
+    if not stored_messages.done:
+        raise SkipHandler()
+
+
+def media_caption(header: str, caption: typing.Optional[str]) -> str:
+    if caption is None:
+        return header
+    return header + "<blockquote expandable>{msg}</blockquote>".format(msg=caption)
+
+
+async def send_media(bot: Bot, user: UserData, message: MessageData, file_id: str, text: str) -> None:
+    if message.media_type == ContentType.PHOTO:
+        await bot.send_photo(chat_id=user.id,
+                             photo=file_id,
+                             caption=text)
+    elif message.media_type == ContentType.VIDEO:
+        await bot.send_video(chat_id=user.id,
+                             video=file_id,
+                             caption=text)
+    elif message.media_type == ContentType.VOICE:
+        try:
+            await bot.send_voice(chat_id=user.id,
+                                 voice=file_id,
+                                 caption=text)
+        except TelegramBadRequest:
+            t = await bot.send_message(chat_id=user.id,
+                                       text=text)
+            await bot.send_message(reply_to_message_id=t.message_id,
+                                   chat_id=user.id,
+                                   text=_("<b>Voice message can't be sent because of your privacy settings!</b>"))
+    elif message.media_type == ContentType.ANIMATION:
+        await bot.send_animation(chat_id=user.id,
+                                 animation=file_id,
+                                 caption=text)
+    elif message.media_type == ContentType.DOCUMENT:
+        await bot.send_document(chat_id=user.id,
+                                document=file_id,
+                                caption=text)
+    elif message.media_type == ContentType.AUDIO:
+        await bot.send_audio(chat_id=user.id,
+                             audio=file_id,
+                             caption=text)
 
 
 # Text
 @message_delete_route.deleted_business_messages(ContentTypeFilter(ContentType.TEXT, ))
-async def text_delete(bdm: BusinessMessagesDeleted, bot: Bot, repo: Repo) -> None:
-    user = repo.users.get_by_connection(get_text_hash(bdm.business_connection_id))
+async def text_delete(bdm: BusinessMessagesDeleted, bot: Bot, repo: Repo, messages: list[MessageData],
+                     stored_messages: StoredMessages, deletion_digest: typing.Optional[DeletionDigest] = None) -> None:
+    user = await repo.users.get_by_connection(get_text_hash(bdm.business_connection_id))
 
     if user is None:
         return
-    connection_id = get_text_hash(bdm.business_connection_id)
 
-    for m in bdm.message_ids:
-        message = repo.messages.get(message_id=m, connection_id=connection_id)
-        if message is None:
-            return
+    await take_messages(repo, stored_messages, messages)
 
-        repo.messages.delete(message)
+    await repo.commit()
 
-        user_link = ""
-        if bdm.chat.has_private_forwards:
-            user_link = f"tg://user?id={bdm.chat.id}"
-        elif bdm.chat.username is not None:
-            user_link = "https://t.me/" + bdm.chat.username
+    texts = await get_encryptor(bdm.business_connection_id).decrypt_many_async(m.message for m in messages)
+
+    user_link = ""
+    if bdm.chat.has_private_forwards:
+        user_link = f"tg://user?id={bdm.chat.id}"
+    elif bdm.chat.username is not None:
+        user_link = "https://t.me/" + bdm.chat.username
 
+    # Many deleted messages are packed into a few long notifications
+    if deletion_digest is not None and len(texts) >= deletion_digest.min_messages:
+        header = _("<b>🗑 Deletion noticed!</b>"
+                   "\n\nMessages by <b><a href='{user_link}'>{name}</a></b>:",
+                   locale=user.language).format(user_link=user_link,
+                                                name=bdm.chat.full_name)
+
+        await deletion_digest.send(bot, chat_id=user.id, header=header, entries=texts)
+        pass_on(stored_messages)
+        return
+
+    for message, msg_text in zip(messages, texts):
         text = _("<b>🗑 Deletion noticed!</b>"
                  "\n\nMessage by <b><a href='{user_link}'>{name}</a></b>:"
                  "<blockquote expandable>{msg}</blockquote>",
                  locale=user.language).format(user_link=user_link,
                                               name=bdm.chat.full_name,
-                                              msg=TextEncryptor(key=bdm.business_connection_id).decrypt(
-                                                  message.message))
+                                              msg=msg_text)
 
         await bot.send_message(chat_id=user.id, text=text)
 
-        await asyncio.sleep(0.4)  # To avoid limit
+    pass_on(stored_messages)
 
 
 # Media (Photo, Video, Voice, Animation, Audio)
@@ -56,86 +147,80 @@ async def text_delete(bdm: BusinessMessagesDeleted, bot: Bot, repo: Repo) -> Non
                                                                   ContentType.ANIMATION,
                                                                   ContentType.AUDIO,
                                                                   ContentType.DOCUMENT, ))
-async def media_delete(bdm: BusinessMessagesDeleted, bot: Bot, repo: Repo) -> None:
-    user = repo.users.get_by_connection(get_text_hash(bdm.business_connection_id))
+async def media_delete(bdm: BusinessMessagesDeleted, bot: Bot, repo: Repo, messages: list[MessageData],
+                      stored_messages: StoredMessages, media_store: MediaStore) -> None:
+    user = await repo.users.get_by_connection(get_text_hash(bdm.business_connection_id))
 
     if user is None:
         return
-    connection_id = get_text_hash(bdm.business_connection_id)
-
-    for m in bdm.message_ids:
-        message = repo.messages.get(message_id=m, connection_id=connection_id)
-        if message is None:
-            return
 
-        repo.messages.delete(message)
-
-        user_link = ""
-        if bdm.chat.has_private_forwards:
-            user_link = f"tg://user?id={bdm.chat.id}"
-        elif bdm.chat.username is not None:
-            user_link = "https://t.me/" + bdm.chat.username
+    await take_messages(repo, stored_messages, messages)
+
+    encryptor = get_encryptor(bdm.business_connection_id)
+    captions = await encryptor.decrypt_many_async(m.message for m in messages)
+    files = await media_store.file_ids(repo, messages, encryptor)
+    await repo.commit()
+
+    user_link = ""
+    if bdm.chat.has_private_forwards:
+        user_link = f"tg://user?id={bdm.chat.id}"
+    elif bdm.chat.username is not None:
+        user_link = "https://t.me/" + bdm.chat.username
+
+    header = _("<b>🗑 Deletion noticed!</b>"
+               "\n\nMessage by <b><a href='{user_link}'>{name}</a></b>:",
+               locale=user.language).format(user_link=user_link,
+                                            name=bdm.chat.full_name)
+
+    # Media that can share an album are sent in albums of up to 10, the rest one by one
+    albums: dict[str, list[tuple[MessageData, typing.Optional[str], str]]] = {}
+    singles = []
+    for item in zip(messages, captions, files):
+        album = ALBUMS.get(item[0].media_type)
+        if album is None:
+            singles.append(item)
+        else:
+            albums.setdefault(album, []).append(item)
 
-        text = _("<b>🗑 Deletion noticed!</b>"
-                 "\n\nMessage by <b><a href='{user_link}'>{name}</a></b>:",
-                 locale=user.language).format(user_link=user_link,
-                                              name=bdm.chat.full_name)
+    for items in albums.values():
+        for i in range(0, len(items), MAX_MEDIA_GROUP_SIZE):
+            album = items[i:i + MAX_MEDIA_GROUP_SIZE]
+            if len(album) == 1:
+                singles.extend(album)
+                continue
 
-        if message.message is None:
-            pass
-        else:
-            text += "<blockquote expandable>{msg}</blockquote>".format(
-                msg=TextEncryptor(key=bdm.business_connection_id).decrypt(message.message))
+            media_group = MediaGroupBuilder()
+            for n, (message, caption, file_id) in enumerate(album):
+                media_group.add(type=message.media_type, media=file_id,
+                                caption=media_caption(header if n == 0 else "", caption) or None)
 
-        if message.media_type == ContentType.PHOTO:
-            await bot.send_photo(chat_id=user.id,
-                                 photo=TextEncryptor(key=bdm.business_connection_id).decrypt(message.media),
-                                 caption=text)
-        elif message.media_type == ContentType.VIDEO:
-            await bot.send_video(chat_id=user.id,
-                                 video=TextEncryptor(key=bdm.business_connection_id).decrypt(message.media),
-                                 caption=text)
-        elif message.media_type == ContentType.VOICE:
             try:
-                await bot.send_voice(chat_id=user.id,
-                                     voice=TextEncryptor(key=bdm.business_connection_id).decrypt(message.media),
-                                     caption=text)
-            except TelegramBadRequest:
-                t = await bot.send_message(chat_id=user.id,
-                                           text=text)
-                await bot.send_message(reply_to_message_id=t.message_id,
-                                       chat_id=user.id,
-                                       text=_("<b>Voice message can't be sent because of your privacy settings!</b>"))
-        elif message.media_type == ContentType.ANIMATION:
-            await bot.send_animation(chat_id=user.id,
-                                     animation=TextEncryptor(key=bdm.business_connection_id).decrypt(message.media),
-                                     caption=text)
-        elif message.media_type == ContentType.DOCUMENT:
-            await bot.send_document(chat_id=user.id,
-                                    document=TextEncryptor(key=bdm.business_connection_id).decrypt(message.media),
-                                    caption=text)
-        else:
-            return
+                await bot.send_media_group(chat_id=user.id, media=media_group.build())
+            except TelegramBadRequest as e:
+                logging.warning(f"Failed to send deleted media as an album, sending one by one: {e}")
+                singles.extend(album)
+
+    for message, caption, file_id in singles:
+        await send_media(bot, user, message, file_id, media_caption(header, caption))
 
-        await asyncio.sleep(0.4)  # To avoid limit
+    pass_on(stored_messages)
 
 
 # No caption media (Stickers, Video note)
 @message_delete_route.deleted_business_messages(ContentTypeFilter(ContentType.STICKER, ContentType.VIDEO_NOTE))
-async def nocap_media_delete(bdm: BusinessMessagesDeleted, bot: Bot, repo: Repo) -> None:
-    user = repo.users.get_by_connection(get_text_hash(bdm.business_connection_id))
+async def nocap_media_delete(bdm: BusinessMessagesDeleted, bot: Bot, repo: Repo, messages: list[MessageData],
+                            stored_messages: StoredMessages, media_store: MediaStore) -> None:
+    user = await repo.users.get_by_connection(get_text_hash(bdm.business_connection_id))
 
     if user is None:
         return
-    connection_id = get_text_hash(bdm.business_connection_id)
 
-    for m in bdm.message_ids:
-        message = repo.messages.get(message_id=m, connection_id=connection_id)
-        if message is None:
-            return
+    await take_messages(repo, stored_messages, messages)
 
-        repo.messages.delete(message)
+    files = await media_store.file_ids(repo, messages, get_encryptor(bdm.business_connection_id))
+    await repo.commit()
 
+    for message, file_id in zip(messages, files):
         user_link = ""
         if bdm.chat.has_private_forwards:
             user_link = f"tg://user?id={bdm.chat.id}"
@@ -152,15 +237,13 @@ async def nocap_media_delete(bdm: BusinessMessagesDeleted, bot: Bot, repo: Repo)
         if message.is_sticker:
             await bot.send_sticker(chat_id=user.id,
                                    reply_to_message_id=t.message_id,
-                                   sticker=TextEncryptor(key=bdm.business_connection_id).decrypt(message.sticker))
+                                   sticker=file_id)
         elif message.media_type == ContentType.VIDEO_NOTE:
             await bot.send_video_note(chat_id=user.id,
                                       reply_to_message_id=t.message_id,
-                                      video_note=TextEncryptor(key=bdm.business_connection_id).decrypt(message.media))
-        else:
-            return
+                                      video_note=file_id)
 
-        await asyncio.sleep(0.4)  # To avoid limit
+    pass_on(stored_messages)
 
 
 @message_delete_route.edited_business_message()
@@ -7,17 +7,20 @@ from aiogram.utils.i18n import gettext as _
 from aiogram.utils.media_group import MediaGroupBuilder
 
 from filters.ContentTypeFilter import ContentTypeFilter
+from middlewares.stored_messages import StoredMessages
 from repo import Repo
+from repo.media import MediaStore, message_file
 from repo.modules.messages import MessageData
 from repo.modules.users import UserData
-from utils.encryptor import get_text_hash, TextEncryptor
+from utils.encryptor import get_text_hash, get_encryptor
+from utils.history import EditHistory
 
 message_edit_route = Router()
 
 
-async def get_data(repo: Repo, business_connection_id,
-                      from_user_id, message_id) -> typing.Optional[tuple[UserData, MessageData]]:
-    user = repo.users.get_by_connection(get_text_hash(business_connection_id))
+async def get_data(repo: Repo, stored_messages: StoredMessages, business_connection_id,
+                   from_user_id) -> typing.Optional[tuple[UserData, MessageData]]:
+    user = await repo.users.get_by_connection(get_text_hash(business_connection_id))
 
     if user is None:
         return
@@ -25,9 +28,7 @@ async def get_data(repo: Repo, business_connection_id,
     if user.id == from_user_id:
         return
 
-    connection_id = get_text_hash(business_connection_id)
-
-    message = repo.messages.get(message_id=message_id, connection_id=connection_id)
+    message = await stored_messages.get()
 
     if message is None:
         return
@@ -37,12 +38,19 @@ async def get_data(repo: Repo, business_connection_id,
 
 # Text edit handler
 @message_edit_route.edited_business_message(ContentTypeFilter(ContentType.TEXT, ))
-async def text_edit(bm: Message, bot: Bot, repo: Repo) -> None:
-    data = await get_data(repo, bm.business_connection_id, bm.from_user.id, bm.message_id)
+async def text_edit(bm: Message, bot: Bot, repo: Repo, stored_messages: StoredMessages,
+                    edit_history: typing.Optional[EditHistory] = None) -> None:
+    data = await get_data(repo, stored_messages, bm.business_connection_id, bm.from_user.id)
     if data is None: return
 
     message = data[1]
     user = data[0]
+    encryptor = get_encryptor(bm.business_connection_id)
+    old_text = encryptor.decrypt(message.message)
+
+    # Nothing changed, e.g. a replayed update
+    if old_text == bm.html_text:
+        return
 
     user_link = ""
     if bm.chat.has_private_forwards:
@@ -58,11 +66,14 @@ async def text_edit(bm: Message, bot: Bot, repo: Repo) -> None:
              locale=user.language).format(user_link=user_link,
                                           name=bm.chat.full_name,
                                           new_msg=bm.html_text,
-                                          old_msg=TextEncryptor(key=bm.business_connection_id).decrypt(
-                                              message.message))
+                                          old_msg=old_text)
 
-    message.message = TextEncryptor(key=bm.business_connection_id).encrypt(bm.html_text)
-    repo.save()
+    values = dict(message=encryptor.encrypt(bm.html_text))
+    if edit_history is not None:
+        values["version"] = edit_history.record(repo, message, encryptor, old_text, bm.html_text)
+    await repo.messages.update(message.connection_id, message.message_id, **values)
+    # Sending is rate limited, the connection is not held meanwhile
+    await repo.commit()
 
     await bot.send_message(chat_id=user.id, text=text)
 
@@ -74,12 +85,22 @@ async def text_edit(bm: Message, bot: Bot, repo: Repo) -> None:
                                                                ContentType.VOICE,
                                                                ContentType.AUDIO,
                                                                ContentType.DOCUMENT))
-async def media_edit(bm: Message, bot: Bot, repo: Repo) -> None:
-    data = await get_data(repo, bm.business_connection_id, bm.from_user.id, bm.message_id)
+async def media_edit(bm: Message, bot: Bot, repo: Repo, stored_messages: StoredMessages, media_store: MediaStore,
+                     edit_history: typing.Optional[EditHistory] = None) -> None:
+    data = await get_data(repo, stored_messages, bm.business_connection_id, bm.from_user.id)
     if data is None: return
 
     message = data[1]
     user = data[0]
+    encryptor = get_encryptor(bm.business_connection_id)
+    old_text = encryptor.decrypt(message.message) if message.message is not None else ""
+    old_media = (await media_store.file_ids(repo, [message], encryptor))[0]
+    media = message_file(bm)[0]
+    media_id = await media_store.put_message(repo, bm)
+
+    # Nothing changed, e.g. a replayed update
+    if old_text == bm.html_text and message.media_id == media_id:
+        return
 
     user_link = ""
     if bm.chat.has_private_forwards:
@@ -95,42 +116,35 @@ async def media_edit(bm: Message, bot: Bot, repo: Repo) -> None:
              locale=user.language).format(user_link=user_link,
                                           name=bm.chat.full_name,
                                           new_msg=bm.html_text,
-                                          old_msg=TextEncryptor(key=bm.business_connection_id).decrypt(
-                                              message.message) if message.message is not None else "")
+                                          old_msg=old_text)
 
-    message.message = TextEncryptor(key=bm.business_connection_id).encrypt(bm.html_text)
-    repo.save()
-
-    if bm.content_type == ContentType.PHOTO:
-        media = bm.photo[-1].file_id
-    else:
-        media = bm.model_dump()[bm.content_type]['file_id']
+    values = dict(message=encryptor.encrypt(bm.html_text), media_id=media_id, media=None)
+    if edit_history is not None:
+        values["version"] = edit_history.record(repo, message, encryptor, old_text, bm.html_text,
+                                                old_media=old_media, new_media=media)
+    await repo.messages.update(message.connection_id, message.message_id, **values)
+    await repo.commit()
 
     if bm.content_type not in [ContentType.ANIMATION]:
         media_group = MediaGroupBuilder(caption=text)
         media_group.add(type=message.media_type if message.media_type not in [ContentType.VOICE] else ContentType.AUDIO,
-                        media=TextEncryptor(key=bm.business_connection_id).decrypt(message.media))
+                        media=old_media)
 
-        if media != TextEncryptor(key=bm.business_connection_id).decrypt(message.media):
+        if media != old_media:
             media_group.add(type=bm.content_type if bm.content_type not in [ContentType.VOICE] else ContentType.AUDIO,
                             media=media)
 
-        message.media = TextEncryptor(key=bm.business_connection_id).encrypt(media)
-        repo.save()
-
         await bot.send_media_group(chat_id=user.id, media=media_group.build())
     else:
         if bm.content_type == ContentType.ANIMATION:
-            message.media = TextEncryptor(key=bm.business_connection_id).encrypt(media)
-            repo.save()
-
             await bot.send_animation(chat_id=user.id, animation=media, caption=text)
 
 
 # Location change handler
 @message_edit_route.edited_business_message(ContentTypeFilter(ContentType.LOCATION, ))
 async def location_edit(bm: Message, bot: Bot, repo: Repo) -> None:
-    user = repo.users.get_by_connection(connection_id=get_text_hash(bm.business_connection_id))
+    user = await repo.users.get_by_connection(connection_id=get_text_hash(bm.business_connection_id))
+    await repo.commit()
 
     user_link = ""
     if bm.chat.has_private_forwards:
@@ -0,0 +1,29 @@
+from aiogram import Router, Bot
+from aiogram.dispatcher.event.bases import SkipHandler
+from aiogram.filters import Command
+from aiogram.types import Message
+from aiogram.utils.i18n import gettext as _
+
+from repo import Repo
+from utils.encryptor import get_text_hash
+from utils.export import HistoryExporter
+
+message_export_route = Router()
+
+
+# Sent by the owner in any business chat, as only the business connection id decrypts their messages
+@message_export_route.business_message(Command("export"))
+async def export_handle(msg: Message, repo: Repo, bot: Bot, history_exporter: HistoryExporter) -> None:
+    user = await repo.users.get_by_connection(get_text_hash(msg.business_connection_id))
+
+    # "/export" sent by anyone else is an ordinary message
+    if user is None or user.id != msg.from_user.id:
+        raise SkipHandler()
+
+    started = history_exporter.start(bot=bot,
+                                     user_id=user.id,
+                                     business_connection_id=msg.business_connection_id,
+                                     caption=lambda count: _("<b>📦 Your stored messages</b>: {count}").format(
+                                         count=count))
+    if not started:
+        await bot.send_message(chat_id=user.id, text=_("⏳ Your export is already being prepared"))
@@ -7,21 +7,21 @@ from aiogram.utils.i18n import gettext as _
 
 from filters.ContentTypeFilter import ContentTypeFilter
 from repo import Repo
+from repo.media import MediaStore
 from repo.modules.messages import MessageData
-from utils.encryptor import get_text_hash, TextEncryptor
+from utils.encryptor import get_text_hash, get_encryptor
 
 message_receive_route = Router()
-bad_users = []  # Used to prevent spam if user is not found in db
 
 
 # Text
 @message_receive_route.business_message(ContentTypeFilter(ContentType.TEXT,))
 async def text_handle(msg: Message, repo: Repo, bot: Bot) -> None:
-    user = repo.users.get_by_connection(get_text_hash(msg.business_connection_id))
+    user = await repo.users.get_by_connection(get_text_hash(msg.business_connection_id))
 
     if user is None:
-        if get_text_hash(msg.business_connection_id) not in bad_users:
-            bad_users.append(get_text_hash(msg.business_connection_id))
+        # Unknown connections are cached, the notice is only sent once per `notified_ttl`
+        if repo.users.notify_unknown(get_text_hash(msg.business_connection_id)):
             bot_info = await bot.me()
             await msg.answer(
                 _("An error has occurred! Please add the bot to your profile again!\n\n<i>via</i> @{bot_username}").format(
@@ -33,19 +33,19 @@ async def text_handle(msg: Message, repo: Repo, bot: Bot) -> None:
 
     msg_data = MessageData(connection_id=get_text_hash(msg.business_connection_id),
                            message_id=msg.message_id,
-                           message=TextEncryptor(key=msg.business_connection_id).encrypt(msg.html_text))
+                           message=get_encryptor(msg.business_connection_id).encrypt(msg.html_text))
 
-    repo.messages.add(message=msg_data)
+    await repo.messages.add(message=msg_data)
 
 
 # Sticker
 @message_receive_route.business_message(ContentTypeFilter(ContentType.STICKER, ))
-async def stick_handle(msg: Message, repo: Repo, bot: Bot) -> None:
-    user = repo.users.get_by_connection(get_text_hash(msg.business_connection_id))
+async def stick_handle(msg: Message, repo: Repo, bot: Bot, media_store: MediaStore) -> None:
+    user = await repo.users.get_by_connection(get_text_hash(msg.business_connection_id))
 
     if user is None:
-        if get_text_hash(msg.business_connection_id) not in bad_users:
-            bad_users.append(get_text_hash(msg.business_connection_id))
+        # Unknown connections are cached, the notice is only sent once per `notified_ttl`
+        if repo.users.notify_unknown(get_text_hash(msg.business_connection_id)):
             bot_info = await bot.me()
             await msg.answer(
                 _("An error has occurred! Please add the bot to your profile again!\n\n<i>via</i> @{bot_username}").format(
@@ -55,12 +55,13 @@ async def stick_handle(msg: Message, repo: Repo, bot: Bot) -> None:
     if user.id == msg.from_user.id:
         return
 
+    # Files are stored once, the message only references it
     msg_data = MessageData(connection_id=get_text_hash(msg.business_connection_id),
                            message_id=msg.message_id,
                            is_sticker=True,
-                           sticker=TextEncryptor(key=msg.business_connection_id).encrypt(msg.sticker.file_id))
+                           media_id=await media_store.put_message(repo, msg))
 
-    repo.messages.add(message=msg_data)
+    await repo.messages.add(message=msg_data)
 
 
 # Media (Video, Animation, Voice, Photo, Audio)
@@ -75,12 +76,12 @@ async def stick_handle(msg: Message, repo: Repo, bot: Bot) -> None:
         ContentType.DOCUMENT,
     )
 )
-async def media_handle(msg: Message, repo: Repo, bot: Bot) -> None:
-    user = repo.users.get_by_connection(get_text_hash(msg.business_connection_id))
+async def media_handle(msg: Message, repo: Repo, bot: Bot, media_store: MediaStore) -> None:
+    user = await repo.users.get_by_connection(get_text_hash(msg.business_connection_id))
 
     if user is None:
-        if get_text_hash(msg.business_connection_id) not in bad_users:
-            bad_users.append(get_text_hash(msg.business_connection_id))
+        # Unknown connections are cached, the notice is only sent once per `notified_ttl`
+        if repo.users.notify_unknown(get_text_hash(msg.business_connection_id)):
             bot_info = await bot.me()
             await msg.answer(
                 _("An error has occurred! Please add the bot to your profile again!\n\n<i>via</i> @{bot_username}").format(
@@ -94,13 +95,11 @@ async def media_handle(msg: Message, repo: Repo, bot: Bot) -> None:
                            message_id=msg.message_id,
                            is_media=True,
                            media_type=msg.content_type,
-                           media=TextEncryptor(key=msg.business_connection_id).encrypt(
-                               msg.model_dump()[msg.content_type][
-                                   'file_id'] if msg.content_type != ContentType.PHOTO else msg.photo[-1].file_id),
-                           message=TextEncryptor(key=msg.business_connection_id).encrypt(
+                           media_id=await media_store.put_message(repo, msg),
+                           message=get_encryptor(msg.business_connection_id).encrypt(
                                msg.caption) if msg.caption is not None else None)
 
-    repo.messages.add(message=msg_data)
+    await repo.messages.add(message=msg_data)
 
 
 @message_receive_route.business_message()
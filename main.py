@@ -1,7 +1,10 @@
 import asyncio
 import logging
+import typing
 
 from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from aiogram.enums import ParseMode, ContentType
 from aiogram.types import BusinessConnection, Message, BotCommand
 from aiogram.utils.i18n import gettext as _, I18n, SimpleI18nMiddleware
@@ -9,12 +12,31 @@ from aiogram.utils.i18n import gettext as _, I18n, SimpleI18nMiddleware
 from filters.ContentTypeFilter import ContentTypeFilter
 from handlers.deleting import message_delete_route
 from handlers.edit import message_edit_route
+from handlers.export import message_export_route
 from handlers.receive import message_receive_route
+from middlewares.coalesce import LocationCoalescingMiddleware
+from middlewares.database import DatabaseMiddleware
+from middlewares.metrics import MetricsMiddleware, HandlerMetricsMiddleware, RequestMetricsMiddleware
+from middlewares.ordering import OrderedDispatchMiddleware
+from middlewares.rate_limit import RateLimitMiddleware, SendPriorityMiddleware, Priority
+from middlewares.stored_messages import StoredMessagesMiddleware
+from middlewares.tracing import TracingMiddleware, TracingRequestMiddleware
 from middlewares.user_check import UsersMiddleware
-from repo import Repo
+from repo import Repo, Database
+from repo.buffer import MessageBuffer
+from repo.cache import UsersCache
+from repo.media import MediaStore
+from repo.reencode import PayloadReencoder
+from repo.retention import RetentionPruner
 from repo.modules.users import UserData
 from utils.config import config
+from utils.digest import DeletionDigest
 from utils.encryptor import get_text_hash
+from utils.export import HistoryExporter
+from utils.history import EditHistory
+from utils import tracing
+from utils.metrics import registry, instrument_engine, start_server
+from utils.workers import Supervisor
 
 logging.basicConfig(level=logging.INFO,
                     format="[%(asctime)s][%(levelname)s][%(funcName)s][%(module)s][%(lineno)d] - %(message)s")
@@ -22,31 +44,142 @@ logging.basicConfig(level=logging.INFO,
 dp = Dispatcher()
 i18n = I18n(path="locales", default_locale="en", domain="messages")
 
+db = Database(
+    url=config.DATABASE.url,
+    pool_size=config.DATABASE.pool_size,
+    max_overflow=config.DATABASE.max_overflow,
+    pool_recycle=config.DATABASE.pool_recycle,
+    pool_pre_ping=config.DATABASE.pool_pre_ping,
+)
+buffer = None
+if config.BUFFER.enabled:
+    buffer = MessageBuffer(db=db, max_rows=config.BUFFER.max_rows, interval_ms=config.BUFFER.interval_ms)
+
+pruner = RetentionPruner(
+    db=db,
+    days=config.RETENTION.days,
+    interval=config.RETENTION.interval,
+    batch_size=config.RETENTION.batch_size,
+    batch_pause_ms=config.RETENTION.batch_pause_ms,
+    # Files cached as stored are seen within the cache ttl, so they are never pruned
+    media_grace=config.CACHE.media_ttl * 2,
+)
+reencoder = PayloadReencoder(
+    db=db,
+    batch_size=config.STORAGE.batch_size,
+    batch_pause_ms=config.STORAGE.batch_pause_ms,
+)
+users_cache = UsersCache(maxsize=config.CACHE.users_size, ttl=config.CACHE.users_ttl,
+                         unknown_maxsize=config.CACHE.unknown_size, unknown_ttl=config.CACHE.unknown_ttl,
+                         notified_maxsize=config.CACHE.notified_size, notified_ttl=config.CACHE.notified_ttl)
+media_store = MediaStore(token=config.BOT.token, maxsize=config.CACHE.media_size, ttl=config.CACHE.media_ttl)
+dp["media_store"] = media_store
+
+deletion_digest = None
+if config.DIGEST.enabled:
+    deletion_digest = DeletionDigest(min_messages=config.DIGEST.min_messages, window_ms=config.DIGEST.window_ms)
+    dp["deletion_digest"] = deletion_digest
+
+edit_history = None
+if config.HISTORY.enabled:
+    edit_history = EditHistory(snapshot_every=config.HISTORY.snapshot_every)
+    dp["edit_history"] = edit_history
+
+history_exporter = None
+if config.EXPORT.enabled:
+    history_exporter = HistoryExporter(db=db, media_store=media_store, buffer=buffer, edit_history=edit_history,
+                                       chunk_size=config.EXPORT.chunk_size, concurrency=config.EXPORT.concurrency)
+    dp["history_exporter"] = history_exporter
+
+ordering = OrderedDispatchMiddleware(
+    workers=config.DISPATCH.workers,
+    max_pending=config.DISPATCH.max_pending,
+    max_per_connection=config.DISPATCH.max_per_connection,
+    admission_timeout=config.DISPATCH.admission_timeout,
+)
+
+location_coalescing = None
+if config.LOCATION.window > 0:
+    # Repeated live location edits are dropped before they take a place in the queues
+    location_coalescing = LocationCoalescingMiddleware(window=config.LOCATION.window,
+                                                       max_tracked=config.LOCATION.max_tracked)
+    dp.update.outer_middleware(location_coalescing)
+dp.update.outer_middleware(ordering)
+if config.TRACING.enabled:
+    tracing.instrument_engine(db.engine)
+    dp.update.outer_middleware(TracingMiddleware(
+        slow_log=tracing.SlowLog(path=config.TRACING.path,
+                                 slow_ms=config.TRACING.slow_ms,
+                                 slow_queries=config.TRACING.slow_queries),
+        sample_rate=config.TRACING.sample_rate,
+        max_spans=config.TRACING.max_spans,
+    ))
+if config.METRICS.enabled:
+    dp.update.middleware(MetricsMiddleware())
 dp.update.middleware(SimpleI18nMiddleware(i18n=i18n))
+dp.update.middleware(DatabaseMiddleware(db=db, buffer=buffer, users_cache=users_cache))
 dp.update.middleware(UsersMiddleware())
+dp.update.middleware(StoredMessagesMiddleware())
 
-dp.include_routers(message_receive_route, message_edit_route, message_delete_route)
+if config.METRICS.enabled:
+    # Inner middlewares of the dispatcher observers also wrap the handlers of every included router
+    for observer in (dp.business_connection, dp.business_message, dp.edited_business_message,
+                     dp.deleted_business_messages, dp.message):
+        observer.middleware(HandlerMetricsMiddleware())
 
-repo = Repo(
-    username=config.DATABASE.username,
-    password=config.DATABASE.password,
-    ip=config.DATABASE.ip,
-    port=config.DATABASE.port,
-    db=config.DATABASE.db,
-)
+    instrument_engine(db.engine)
+
+    registry.gauge("bot_dispatch_queue_depth", "Updates waiting or being handled", lambda: ordering.depth)
+    registry.gauge("bot_dispatch_connections", "Connections with queued updates", lambda: ordering.connections)
+    registry.callback_counter("bot_dispatch_dropped_updates", "Updates dropped because of overload",
+                              lambda: ordering.shed)
+    if location_coalescing is not None:
+        registry.callback_counter("bot_location_edits_coalesced", "Live location edits dropped as repeated",
+                                  lambda: location_coalescing.coalesced)
+    registry.callback_counter("bot_users_cache_hits", "Users cache hits",
+                              lambda: users_cache.by_id.hits + users_cache.by_connection.hits)
+    registry.callback_counter("bot_users_cache_misses", "Users cache misses",
+                              lambda: users_cache.by_id.misses + users_cache.by_connection.misses)
+    registry.callback_counter("bot_unknown_connections_cache_hits",
+                              "Updates of unknown connections served without a query",
+                              lambda: users_cache.unknown.hits)
+    registry.callback_counter("bot_unknown_connections_cache_misses", "Unknown connections cache misses",
+                              lambda: users_cache.unknown.misses)
+    registry.gauge("bot_unknown_connections", "Cached unknown connections", lambda: len(users_cache.unknown))
+    registry.callback_counter("bot_media_cache_hits", "Media cache hits",
+                              lambda: media_store.ids.hits + media_store.files.hits)
+    registry.callback_counter("bot_media_cache_misses", "Media cache misses",
+                              lambda: media_store.ids.misses + media_store.files.misses)
+    registry.callback_counter("bot_retention_pruned_messages", "Messages deleted by the retention policy",
+                              lambda: pruner.pruned)
+    if buffer is not None:
+        registry.gauge("bot_buffer_pending_messages", "Messages waiting to be written", lambda: len(buffer))
+
+metrics_server: typing.Optional[web.AppRunner] = None
+
+dp.business_connection.middleware(SendPriorityMiddleware(Priority.HIGH))
+dp.message.middleware(SendPriorityMiddleware(Priority.HIGH))
 
-dp["repo"] = repo
+if history_exporter is not None:
+    # Before receiving, so the command of the owner is not taken for a message to store
+    dp.include_router(message_export_route)
+dp.include_routers(message_receive_route, message_edit_route, message_delete_route)
 
 
 @dp.business_connection()
-async def connection_handler(bc: BusinessConnection, bot: Bot) -> None:
+async def connection_handler(bc: BusinessConnection, bot: Bot, repo: Repo) -> None:
     connection_id = get_text_hash(bc.id)
 
-    user = repo.users.get(bc.user.id)
+    # The connection changed or was disabled, cached copies of the user are stale
+    repo.users.invalidate(user_id=bc.user.id, connection_id=connection_id)
+
+    user = await repo.users.get(bc.user.id)
 
     if not bc.is_enabled:
-        repo.messages.delete_by_cid(connection_id=connection_id)
-        repo.users.delete(user=user)
+        await repo.messages.delete_by_cid(connection_id=connection_id)
+        await repo.versions.delete_by_cid(connection_id=connection_id)
+        if user is not None:
+            await repo.users.delete(user=user)
 
         text = _("⚠ All your data was cleared because of disconnecting")
 
@@ -55,13 +188,13 @@ async def connection_handler(bc: BusinessConnection, bot: Bot) -> None:
 
     if user is not None:
         if user.connection_id != connection_id:
-            user.connection_id = connection_id
-            repo.save()
+            await repo.users.update_connection_id(user, connection_id)
 
-            repo.messages.delete_by_cid(connection_id=connection_id)
-    s = repo.users.add(UserData(id=bc.user.id,
-                                connection_id=get_text_hash(bc.id),
-                                language=bc.user.language_code))
+            await repo.messages.delete_by_cid(connection_id=connection_id)
+            await repo.versions.delete_by_cid(connection_id=connection_id)
+    s = await repo.users.add(UserData(id=bc.user.id,
+                                      connection_id=get_text_hash(bc.id),
+                                      language=bc.user.language_code))
 
     if s:
         text = _("Hello, <b><a href='tg://user?id={user_id}'>{name}</a></b>!"
@@ -88,12 +221,100 @@ async def get_chat_id(msg: Message, bot: Bot) -> None:
                          photo="https://omeba-work.com/screenshoot/fc36db79d525fb040fbad9c8039c8dca.jpg")
 
 
-async def main() -> None:
+async def run_webhook(bot: Bot) -> None:
+    app = web.Application()
+
+    # Updates are only queued by OrderedDispatchMiddleware, so Telegram gets its answer right away
+    # unless the queues are full
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=False,
+        secret_token=config.WEBHOOK.secret or None,
+    ).register(app, path=config.WEBHOOK.path)
+    setup_application(app, dp, bot=bot)
+
+    # Without a public url the server can still be fed with updates locally
+    if config.WEBHOOK.url:
+        await bot.set_webhook(
+            url=config.WEBHOOK.url.rstrip("/") + config.WEBHOOK.path,
+            secret_token=config.WEBHOOK.secret or None,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+
+    try:
+        await web.TCPSite(runner, host=config.WEBHOOK.host, port=config.WEBHOOK.port).start()
+        logging.info(f"Webhook server is listening on {config.WEBHOOK.host}:{config.WEBHOOK.port}{config.WEBHOOK.path}")
+
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+
+
+@dp.startup()
+async def on_startup(run_pruner: bool = True, worker: int = 0) -> None:
+    global metrics_server
+
+    if buffer is not None:
+        buffer.start()
+    if run_pruner:
+        pruner.start()
+        if config.STORAGE.reencode:
+            reencoder.start()
+
+    if config.METRICS.enabled:
+        port = config.METRICS.port + worker
+        metrics_server = await start_server(host=config.METRICS.host, port=port, path=config.METRICS.path)
+        logging.info(f"Metrics are served on {config.METRICS.host}:{port}{config.METRICS.path}")
+
+
+@dp.shutdown()
+async def on_shutdown() -> None:
+    if metrics_server is not None:
+        await metrics_server.cleanup()
+
+    await ordering.stop()
+    if deletion_digest is not None:
+        await deletion_digest.flush()
+    if history_exporter is not None:
+        await history_exporter.stop()
+    await pruner.stop()
+    await reencoder.stop()
+    if buffer is not None:
+        await buffer.stop()
+
+
+def create_bot(rate_share: float = 1) -> Bot:
+    """Creates a bot whose sending rate is `rate_share` of the global limit"""
     bot = Bot(
         token=config.BOT.token,
         parse_mode=ParseMode.HTML,
         disable_web_page_preview=True,
     )
+    rate_limit = RateLimitMiddleware(
+        global_rate=config.RATE_LIMIT.global_rate * rate_share,
+        chat_rate=config.RATE_LIMIT.chat_rate,
+        chat_burst=config.RATE_LIMIT.chat_burst,
+        group_rate=config.RATE_LIMIT.group_rate,
+        max_retries=config.RATE_LIMIT.max_retries,
+    )
+    bot.session.middleware(rate_limit)
+
+    if config.METRICS.enabled:
+        # Registered after the rate limiter, so the time spent waiting for sending is not counted
+        bot.session.middleware(RequestMetricsMiddleware())
+        registry.gauge("bot_outgoing_queue_depth", "Requests waiting to be sent", lambda: rate_limit.depth)
+    if config.TRACING.enabled:
+        bot.session.middleware(TracingRequestMiddleware())
+    return bot
+
+
+async def main() -> None:
+    bot = create_bot()
 
     # English commands translation
     await bot.set_my_commands(
@@ -117,7 +338,24 @@ async def main() -> None:
         language_code="uk"
     )
 
-    await dp.start_polling(bot)
+    await db.create_tables()
+
+    try:
+        if config.WORKERS.count > 1:
+            await bot.delete_webhook()
+            await bot.session.close()
+            await Supervisor(token=config.BOT.token,
+                             workers=config.WORKERS.count,
+                             health_interval=config.WORKERS.health_interval,
+                             allowed_updates=dp.resolve_used_update_types()).run()
+        elif config.WEBHOOK.enabled:
+            await run_webhook(bot)
+        else:
+            await bot.delete_webhook()
+            # Concurrency is handled by OrderedDispatchMiddleware, polling waits when its queues are full
+            await dp.start_polling(bot, handle_as_tasks=False)
+    finally:
+        await db.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,37 @@
+from typing import Callable, Dict, Any, Awaitable
+
+from aiogram import BaseMiddleware
+from aiogram.enums import ContentType
+from aiogram.types import TelegramObject, Update
+
+from utils.cache import TTLCache
+
+
+class LocationCoalescingMiddleware(BaseMiddleware):
+    """
+    Outer update middleware that drops repeated edits of a location message.
+
+    Live locations are edited every few seconds. Only the first edit of a message in every
+    `window` seconds is handled, the others are dropped before they are queued, so they cost
+    neither queries nor requests. At most `max_tracked` messages are tracked at once.
+    """
+
+    def __init__(self, window: float = 300, max_tracked: int = 10000) -> None:
+        self.window = window
+
+        self.coalesced = 0  # Edits dropped since start
+        self._seen: TTLCache[tuple[str, int, int], bool] = TTLCache(maxsize=max_tracked, ttl=window)
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]], event: Update,
+                       data: Dict[str, Any]) -> Any:
+        message = event.edited_business_message
+        if message is None or message.content_type != ContentType.LOCATION:
+            return await handler(event, data)
+
+        key = (message.business_connection_id, message.chat.id, message.message_id)
+        if self._seen.peek(key) is not None:
+            self.coalesced += 1
+            return None
+
+        self._seen.set(key, True)
+        return await handler(event, data)
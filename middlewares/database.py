@@ -0,0 +1,33 @@
+from typing import Callable, Dict, Any, Awaitable, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from repo import Repo, Database
+from repo.buffer import MessageBuffer
+from repo.cache import UsersCache
+
+
+class DatabaseMiddleware(BaseMiddleware):
+    """Gives every update its own pooled session and commits it once the update is handled"""
+
+    def __init__(self, db: Database, buffer: Optional[MessageBuffer] = None,
+                 users_cache: Optional[UsersCache] = None) -> None:
+        self.db = db
+        self.buffer = buffer
+        self.users_cache = users_cache
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]], event: TelegramObject,
+                       data: Dict[str, Any]) -> Any:
+        async with self.db.session() as session:
+            repo = Repo(session, buffer=self.buffer, users_cache=self.users_cache)
+            data["repo"] = repo
+
+            try:
+                result = await handler(event, data)
+            except Exception:
+                await repo.rollback()
+                raise
+
+            await repo.commit()
+            return result
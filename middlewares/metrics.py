@@ -0,0 +1,57 @@
+import time
+from typing import Callable, Dict, Any, Awaitable
+
+from aiogram import Bot, BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.methods import TelegramMethod, Response
+from aiogram.types import TelegramObject, Update
+
+from utils.metrics import UPDATES, UPDATE_LATENCY, HANDLER_LATENCY, API_REQUESTS, API_LATENCY
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Counts updates by type and result and times their handling, filters included"""
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]], event: Update,
+                       data: Dict[str, Any]) -> Any:
+        result = "error"
+        start = time.perf_counter()
+        try:
+            response = await handler(event, data)
+            result = "unhandled" if response is UNHANDLED else "handled"
+            return response
+        finally:
+            UPDATES.inc(type=event.event_type, result=result)
+            UPDATE_LATENCY.observe(time.perf_counter() - start, type=event.event_type)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Times the handler chosen for an event.
+
+    Has to be registered on the observers of the dispatcher, so it runs for the handlers of every router.
+    """
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]], event: TelegramObject,
+                       data: Dict[str, Any]) -> Any:
+        callback = data["handler"].callback
+        with HANDLER_LATENCY.time(router=callback.__module__, handler=callback.__name__):
+            return await handler(event, data)
+
+
+class RequestMetricsMiddleware(BaseRequestMiddleware):
+    """Counts Bot API requests by method and times them, register it after RateLimitMiddleware"""
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot,
+                       method: TelegramMethod) -> Response:
+        name = type(method).__name__
+        result = "error"
+        start = time.perf_counter()
+        try:
+            response = await make_request(bot, method)
+            result = "ok"
+            return response
+        finally:
+            API_REQUESTS.inc(method=name, result=result)
+            API_LATENCY.observe(time.perf_counter() - start, method=name)
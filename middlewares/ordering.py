@@ -0,0 +1,140 @@
+import asyncio
+import collections
+import contextlib
+import logging
+import typing
+from typing import Callable, Dict, Any, Awaitable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update, BusinessConnection
+
+Job = tuple[Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]], TelegramObject, Dict[str, Any]]
+
+
+def ordering_key(update: Update, data: Dict[str, Any]) -> typing.Hashable:
+    """Updates with the same key are handled one after another in arrival order"""
+    event = update.event
+    if isinstance(event, BusinessConnection):
+        return event.id
+
+    business_connection_id = getattr(event, "business_connection_id", None)
+    if business_connection_id is not None:
+        return business_connection_id
+
+    chat = data.get("event_chat")
+    if chat is not None:
+        return chat.id
+
+    return update.update_id
+
+
+class OrderedDispatchMiddleware(BaseMiddleware):
+    """
+    Outer update middleware that queues updates per business connection.
+
+    Queues are drained by a fixed pool of `workers` tasks and a queue is never handled by
+    two workers at once, so a message is always stored before its edit or deletion is handled.
+    Updates are accepted right away while fewer than `max_pending` are queued, otherwise the caller
+    waits up to `admission_timeout` seconds for space (backpressure) before the update is dropped.
+    Connections with more than `max_per_connection` queued updates have new ones dropped.
+    """
+
+    def __init__(self, workers: int = 24, max_pending: int = 1000, max_per_connection: int = 200,
+                 admission_timeout: float = 5) -> None:
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_per_connection = max_per_connection
+        self.admission_timeout = admission_timeout
+
+        self.shed = 0  # Updates dropped because of overload
+
+        self._queues: dict[typing.Hashable, collections.deque[Job]] = {}
+        self._ready: typing.Optional[asyncio.Queue] = None
+        self._space: typing.Optional[asyncio.Condition] = None
+        self._pending = 0
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def depth(self) -> int:
+        """Updates waiting or being handled"""
+        return self._pending
+
+    @property
+    def connections(self) -> int:
+        """Connections with queued updates"""
+        return len(self._queues)
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]], event: Update,
+                       data: Dict[str, Any]) -> Any:
+        self._ensure_started()
+
+        key = ordering_key(event, data)
+        queue = self._queues.get(key)
+
+        if queue is not None and len(queue) >= self.max_per_connection:
+            return self._drop(event, f"{len(queue)} updates are queued for its connection")
+
+        if self._pending >= self.max_pending:
+            try:
+                async with self._space:
+                    await asyncio.wait_for(self._space.wait_for(lambda: self._pending < self.max_pending),
+                                           timeout=self.admission_timeout)
+            except asyncio.TimeoutError:
+                return self._drop(event, f"{self._pending} updates are pending")
+
+            queue = self._queues.get(key)
+
+        self._pending += 1
+        if queue is None:
+            queue = self._queues[key] = collections.deque()
+            self._ready.put_nowait(key)
+        queue.append((handler, event, data))
+
+    def _drop(self, update: Update, reason: str) -> None:
+        self.shed += 1
+        logging.warning(f"Update id={update.update_id} dropped, {reason}")
+
+    def _ensure_started(self) -> None:
+        if self._tasks:
+            return
+
+        self._ready = asyncio.Queue()
+        self._space = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _worker(self) -> None:
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            handler, event, data = queue[0]
+
+            try:
+                await handler(event, data)
+            except Exception as e:
+                logging.exception(f"Failed to handle update id={event.update_id}: {e}")
+            finally:
+                queue.popleft()
+                self._pending -= 1
+
+                # Requeue the connection at the end so busy connections don't starve others
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._queues[key]
+
+                async with self._space:
+                    self._space.notify_all()
+
+    async def stop(self, timeout: float = 30) -> None:
+        """Waits for queued updates to be handled and stops the workers"""
+        if not self._tasks:
+            return
+
+        with contextlib.suppress(asyncio.TimeoutError):
+            async with self._space:
+                await asyncio.wait_for(self._space.wait_for(lambda: self._pending == 0), timeout=timeout)
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
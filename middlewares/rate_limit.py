@@ -0,0 +1,241 @@
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import enum
+import itertools
+import logging
+import typing
+from typing import Callable, Dict, Any, Awaitable
+
+from aiogram import Bot, BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod, Response
+from aiogram.types import TelegramObject
+
+
+class Priority(enum.IntEnum):
+    HIGH = 0  # Direct answers to the owner
+    NORMAL = 1  # Single edit/deletion notifications
+    LOW = 2  # Bulk notifications
+
+
+_priority: contextvars.ContextVar[Priority] = contextvars.ContextVar("send_priority", default=Priority.NORMAL)
+
+
+@contextlib.contextmanager
+def send_priority(priority: Priority):
+    """Sets the priority of requests sent from the current context"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class SendPriorityMiddleware(BaseMiddleware):
+    """Sets the priority of everything sent by the handlers of an observer"""
+
+    def __init__(self, priority: Priority) -> None:
+        self.priority = priority
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]], event: TelegramObject,
+                       data: Dict[str, Any]) -> Any:
+        with send_priority(self.priority):
+            return await handler(event, data)
+
+
+class BulkPriorityMiddleware(BaseMiddleware):
+    """Sends notifications about several messages of one update, e.g. a bulk deletion, at a lower priority"""
+
+    def __init__(self, single: Priority = Priority.NORMAL, bulk: Priority = Priority.LOW) -> None:
+        self.single = single
+        self.bulk = bulk
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]], event: TelegramObject,
+                       data: Dict[str, Any]) -> Any:
+        priority = self.bulk if len(getattr(event, "message_ids", ())) > 1 else self.single
+        with send_priority(priority):
+            return await handler(event, data)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float, now: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+
+        self._tokens = capacity
+        self._updated = now
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available"""
+        self._refill(now)
+        return max(0.0, (1 - self._tokens) / self.rate)
+
+    def consume(self, now: float) -> None:
+        self._refill(now)
+        self._tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self._tokens >= self.capacity
+
+
+class _Waiter(typing.NamedTuple):
+    priority: int
+    seq: int
+    chat_id: typing.Union[int, str]
+    future: asyncio.Future
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Schedules every outgoing request that targets a chat.
+
+    Requests wait in a priority queue until both the global bucket and the bucket of their
+    chat have a token, so notifications are sent as fast as Telegram allows and never faster.
+    Flood control errors pause the whole queue for `retry_after` seconds and the request is retried.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: int = 3,
+                 group_rate: float = 20 / 60, max_retries: int = 3, depth_warning: int = 500) -> None:
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.depth_warning = depth_warning
+
+        self._waiters: list[_Waiter] = []
+        self._seq = itertools.count()
+        self._global: typing.Optional[TokenBucket] = None
+        self._chats: dict[typing.Union[int, str], TokenBucket] = {}
+        self._paused_until = 0.0
+
+        self._wakeup: typing.Optional[asyncio.Event] = None
+        self._task: typing.Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        """Requests waiting to be sent"""
+        return len(self._waiters)
+
+    def depth_by_priority(self) -> dict[Priority, int]:
+        depth = {p: 0 for p in Priority}
+        for w in self._waiters:
+            depth[Priority(w.priority)] += 1
+        return depth
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot,
+                       method: TelegramMethod) -> Response:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        priority = _priority.get()
+        for attempt in itertools.count():
+            await self._acquire(chat_id, priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+
+                logging.warning(f"Flood control on {type(method).__name__} in chat {chat_id}, "
+                                f"pausing sending for {e.retry_after}s")
+                self._pause(e.retry_after)
+
+    async def _acquire(self, chat_id: typing.Union[int, str], priority: Priority) -> None:
+        self._ensure_started()
+
+        waiter = _Waiter(priority, next(self._seq), chat_id, asyncio.get_running_loop().create_future())
+        bisect.insort(self._waiters, waiter)
+        self._wakeup.set()
+
+        if len(self._waiters) == self.depth_warning:
+            logging.warning(f"Outgoing queue depth reached {self.depth_warning}: {self.depth_by_priority()}")
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with contextlib.suppress(ValueError):
+                self._waiters.remove(waiter)
+            raise
+
+    def _pause(self, seconds: float) -> None:
+        loop = asyncio.get_running_loop()
+        self._paused_until = max(self._paused_until, loop.time() + seconds)
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            now = asyncio.get_running_loop().time()
+            self._global = TokenBucket(rate=self.global_rate, capacity=self.global_rate, now=now)
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def _chat_bucket(self, chat_id: typing.Union[int, str], now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {k: b for k, b in self._chats.items() if not b.is_full(now)}
+
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(rate=self.group_rate, capacity=1, now=now)
+            else:
+                bucket = TokenBucket(rate=self.chat_rate, capacity=self.chat_burst, now=now)
+            self._chats[chat_id] = bucket
+
+        return bucket
+
+    async def _sleep(self, delay: float) -> None:
+        self._wakeup.clear()
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = loop.time()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            delay = self._global.delay(now)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            # The first waiter in priority order whose chat is not throttled goes next
+            ready = None
+            delay = float("inf")
+            for waiter in self._waiters:
+                if waiter.future.done():
+                    continue
+
+                chat_delay = self._chat_bucket(waiter.chat_id, now).delay(now)
+                if chat_delay <= 0:
+                    ready = waiter
+                    break
+                delay = min(delay, chat_delay)
+
+            self._waiters = [w for w in self._waiters if not w.future.done() and w is not ready]
+
+            if ready is None:
+                if self._waiters:
+                    await self._sleep(delay)
+                continue
+
+            self._global.consume(now)
+            self._chat_bucket(ready.chat_id, now).consume(now)
+            ready.future.set_result(None)
@@ -0,0 +1,73 @@
+import logging
+import typing
+from typing import Callable, Dict, Any, Awaitable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from repo import Repo
+from repo.modules.messages import MessageData
+from utils.encryptor import get_text_hash
+
+
+class StoredMessages:
+    """
+    Stored copies of the messages an update refers to, queried at most once per update.
+
+    Deletion handlers take the messages of their types and mark them handled,
+    so a deleted batch with several types is split between the handlers.
+    """
+
+    def __init__(self, repo: Repo, business_connection_id: str, chat_id: int, message_ids: list[int]) -> None:
+        self.repo = repo
+        self.connection_id = get_text_hash(business_connection_id)
+        self.chat_id = chat_id
+        self.message_ids = message_ids
+
+        self._messages: typing.Optional[list[MessageData]] = None
+        self._handled: set[int] = set()
+
+    async def all(self) -> list[MessageData]:
+        """Stored messages in the order of the update, unknown ids are skipped"""
+        if self._messages is None:
+            self._messages = await self.repo.messages.get_many(connection_id=self.connection_id,
+                                                               message_ids=self.message_ids)
+            if not self._messages:
+                logging.warning(f"Received update for messages with ids={self.message_ids} in chat={self.chat_id} "
+                                f"that were not found")
+
+        return self._messages
+
+    async def get(self) -> typing.Optional[MessageData]:
+        """The stored message of an update about a single message"""
+        messages = await self.all()
+        return messages[0] if messages else None
+
+    async def pending(self, content_types: typing.Collection[str]) -> list[MessageData]:
+        """Messages of `content_types` that were not handled yet"""
+        return [m for m in await self.all() if m.content_type in content_types and m.message_id not in self._handled]
+
+    def handle(self, messages: typing.Iterable[MessageData]) -> None:
+        self._handled.update(m.message_id for m in messages)
+
+    @property
+    def done(self) -> bool:
+        """Whether every stored message was handled"""
+        return self._messages is not None and all(m.message_id in self._handled for m in self._messages)
+
+
+class StoredMessagesMiddleware(BaseMiddleware):
+    """Gives edit and deletion updates a `stored_messages` resolver shared by their filters and handlers"""
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]], event: Update,
+                       data: Dict[str, Any]) -> Any:
+        if event.edited_business_message is not None:
+            message = event.edited_business_message
+            data["stored_messages"] = StoredMessages(data["repo"], message.business_connection_id,
+                                                     chat_id=message.chat.id, message_ids=[message.message_id])
+        elif event.deleted_business_messages is not None:
+            deleted = event.deleted_business_messages
+            data["stored_messages"] = StoredMessages(data["repo"], deleted.business_connection_id,
+                                                     chat_id=deleted.chat.id, message_ids=deleted.message_ids)
+
+        return await handler(event, data)
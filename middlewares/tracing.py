@@ -0,0 +1,46 @@
+import random
+from typing import Callable, Dict, Any, Awaitable
+
+from aiogram import Bot, BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod, Response
+from aiogram.types import TelegramObject, Update
+
+from utils import tracing
+from utils.tracing import Trace, SlowLog
+
+
+class TracingMiddleware(BaseMiddleware):
+    """
+    Outer update middleware that traces the handling of every update and dumps slow ones.
+
+    Register it after OrderedDispatchMiddleware, so the time an update waits in its queue is not counted.
+    Only `sample_rate` of the updates keep every call, others only count them, which costs
+    a few additions per call. Slow updates are dumped either way.
+    """
+
+    def __init__(self, slow_log: SlowLog, sample_rate: float = 0.1, max_spans: int = 200) -> None:
+        self.slow_log = slow_log
+        self.sample_rate = sample_rate
+        self.max_spans = max_spans
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]], event: Update,
+                       data: Dict[str, Any]) -> Any:
+        trace = Trace(update_id=event.update_id, update_type=event.event_type,
+                      sampled=random.random() < self.sample_rate, max_spans=self.max_spans)
+
+        try:
+            with tracing.activate(trace):
+                return await handler(event, data)
+        finally:
+            if self.slow_log.is_slow(trace):
+                await self.slow_log.write(trace)
+
+
+class TracingRequestMiddleware(BaseRequestMiddleware):
+    """Records Bot API requests into the trace of the update they were sent for"""
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot,
+                       method: TelegramMethod) -> Response:
+        with tracing.span(tracing.API, type(method).__name__):
+            return await make_request(bot, method)
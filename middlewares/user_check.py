@@ -18,14 +18,22 @@ class UsersMiddleware(BaseMiddleware):
         if user is None:
             return await handler(event, data)
 
-        user_data = repo.users.get(user.id)
-
-        if user_data is None or data.get('business_connection_id') is None:
+        if data.get('business_connection_id') is None:
             return await handler(event, data)
 
         connection_id = get_text_hash(data['business_connection_id'])
-        if user_data.connection_id != connection_id:
-            user_data.connection_id = connection_id
-            repo.save()
+
+        # Connections found unknown were checked here already, until the entry expires
+        if repo.users.is_unknown(connection_id):
+            return await handler(event, data)
+
+        # Known connections are served from the users cache, only unknown ones may belong
+        # to a user whose connection id has changed
+        if await repo.users.get_by_connection(connection_id) is not None:
+            return await handler(event, data)
+
+        user_data = await repo.users.get(user.id)
+        if user_data is not None and user_data.connection_id != connection_id:
+            await repo.users.update_connection_id(user_data, connection_id)
 
         return await handler(event, data)
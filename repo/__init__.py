@@ -1 +1 @@
-from .repo import Repo
\ No newline at end of file
+from .repo import Repo, Database
\ No newline at end of file
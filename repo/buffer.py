@@ -0,0 +1,145 @@
+import asyncio
+import contextlib
+import logging
+import typing
+
+from repo.modules.base import upsert
+from repo.modules.messages import MessageData, to_row
+
+if typing.TYPE_CHECKING:
+    from repo.repo import Database
+
+
+class MessageBuffer:
+    """
+    Write-behind buffer for incoming messages.
+
+    Rows are collected in memory and written with one multi-row INSERT every `max_rows` rows
+    or `interval_ms` milliseconds, whichever comes first. Lookups must check the buffer
+    and the database, MessagesRepo does it when a buffer is given to it. A row in the database
+    wins over a pending one, which can only be a replayed update buffered again.
+    """
+
+    def __init__(self, db: "Database", max_rows: int = 500, interval_ms: int = 200) -> None:
+        self.db = db
+        self.max_rows = max_rows
+        self.interval = interval_ms / 1000
+
+        self._pending: dict[tuple[bytes, int], MessageData] = {}
+        self._flush_lock = asyncio.Lock()
+        self._task: typing.Optional[asyncio.Task] = None
+        self._flush_tasks: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def put(self, message: MessageData) -> None:
+        """Adds a message unless it is already pending, a replayed update doesn't replace the original"""
+        self._pending.setdefault((message.connection_id, message.message_id), message)
+
+        if len(self._pending) >= self.max_rows:
+            task = asyncio.create_task(self.flush())
+            self._flush_tasks.add(task)
+            task.add_done_callback(self._flush_tasks.discard)
+
+    async def get(self, connection_id: bytes, message_id: int) -> typing.Optional[MessageData]:
+        if self._flush_lock.locked():
+            # The row may be in the batch being written right now, wait until it is committed
+            async with self._flush_lock:
+                pass
+
+        return self._pending.get((connection_id, message_id))
+
+    async def get_many(self, connection_id: bytes, message_ids: typing.Iterable[int]) -> list[MessageData]:
+        if self._flush_lock.locked():
+            async with self._flush_lock:
+                pass
+
+        return [self._pending[(connection_id, i)] for i in message_ids if (connection_id, i) in self._pending]
+
+    async def update(self, connection_id: bytes, message_id: int, values: dict) -> bool:
+        """Changes a pending message, returns False when it is not pending and has to be updated in the database"""
+        message = self._pending.get((connection_id, message_id))
+        if message is None:
+            if self._flush_lock.locked():
+                # The row may be in the batch being written right now, it can be updated once it is committed
+                async with self._flush_lock:
+                    pass
+            return False
+
+        for key, value in values.items():
+            setattr(message, key, value)
+        return True
+
+    async def discard(self, connection_id: bytes, message_ids: typing.Iterable[int]) -> int:
+        if self._flush_lock.locked():
+            # Rows of the batch being written can only be deleted from the database once it is committed
+            async with self._flush_lock:
+                pass
+
+        return sum(self._pending.pop((connection_id, i), None) is not None for i in message_ids)
+
+    async def discard_connection(self, connection_id: bytes) -> None:
+        if self._flush_lock.locked():
+            async with self._flush_lock:
+                pass
+
+        for key in [k for k in self._pending if k[0] == connection_id]:
+            del self._pending[key]
+
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+
+            messages = list(self._pending.values())
+            self._pending.clear()
+
+            rows = [to_row(m) for m in messages]
+            try:
+                async with self.db.session() as session:
+                    await session.execute(self._insert(), rows)
+                    await session.commit()
+            except Exception as e:
+                logging.error(f"Batch insert of {len(rows)} messages failed, inserting one by one: {e}")
+                await self._insert_each(rows)
+
+            return len(rows)
+
+    def _insert(self):
+        # Messages of replayed updates are already stored
+        return upsert(self.db.engine.dialect.name, MessageData.__table__)
+
+    async def _insert_each(self, rows: list[dict]) -> None:
+        for row in rows:
+            try:
+                async with self.db.session() as session:
+                    await session.execute(self._insert(), row)
+                    await session.commit()
+            except Exception as e:
+                logging.error(e)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.exception(e)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+
+        await self.flush()
+
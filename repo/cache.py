@@ -0,0 +1,65 @@
+import typing
+
+from repo.modules.users import UserData
+from utils.cache import TTLCache
+
+
+class UsersCache:
+    """
+    Users by id and by connection hash, shared between sessions.
+
+    Cached objects are detached from their session, so they must only be read.
+    UsersRepo changes users with plain statements and invalidates the affected entries.
+
+    Connection hashes no user was found for are cached too, so updates of unknown
+    connections don't query the database again until `unknown_ttl` passes. Whether the
+    peer of such a connection was told about it is kept apart for `notified_ttl`.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 600,
+                 unknown_maxsize: int = 10000, unknown_ttl: float = 300,
+                 notified_maxsize: int = 10000, notified_ttl: float = 86400) -> None:
+        self.by_id: TTLCache[int, UserData] = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.by_connection: TTLCache[bytes, UserData] = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.unknown: TTLCache[bytes, bool] = TTLCache(maxsize=unknown_maxsize, ttl=unknown_ttl)
+        # Unknown connections the notice was sent for, it is not sent again while they are here
+        self.notified: TTLCache[bytes, bool] = TTLCache(maxsize=notified_maxsize, ttl=notified_ttl)
+
+    def get(self, id: int) -> typing.Optional[UserData]:
+        return self.by_id.get(id)
+
+    def get_by_connection(self, connection_id: bytes) -> typing.Optional[UserData]:
+        return self.by_connection.get(connection_id)
+
+    def is_unknown(self, connection_id: bytes) -> bool:
+        return self.unknown.get(connection_id) is not None
+
+    def put_unknown(self, connection_id: bytes) -> None:
+        self.unknown.set(connection_id, True)
+
+    def notify_unknown(self, connection_id: bytes) -> bool:
+        """Whether the notice has to be sent for an unknown connection, true once per `notified_ttl`"""
+        if self.notified.peek(connection_id) is not None:
+            return False
+        self.notified.set(connection_id, True)
+        return True
+
+    def put(self, user: UserData) -> None:
+        self.by_id.set(user.id, user)
+        if user.connection_id is not None:
+            self.by_connection.set(user.connection_id, user)
+
+    def invalidate(self, user_id: typing.Optional[int] = None,
+                   connection_id: typing.Optional[bytes] = None) -> None:
+        if user_id is not None:
+            user = self.by_id.pop(user_id)
+            if user is not None and user.connection_id is not None:
+                self.by_connection.pop(user.connection_id)
+
+        if connection_id is not None:
+            # A connection that becomes unknown again is notified again
+            self.unknown.pop(connection_id)
+            self.notified.pop(connection_id)
+            user = self.by_connection.pop(connection_id)
+            if user is not None:
+                self.by_id.pop(user.id)
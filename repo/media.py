@@ -0,0 +1,85 @@
+import hashlib
+import hmac
+import typing
+
+from aiogram.enums import ContentType
+from aiogram.types import Message
+
+from repo.modules.messages import MessageData
+from utils.cache import TTLCache
+from utils.encryptor import TextEncryptor, get_bot_encryptor
+
+if typing.TYPE_CHECKING:
+    from repo.repo import Repo
+
+
+def message_file(message: Message) -> tuple[str, str]:
+    """file_id and file_unique_id of the file of a sticker or media message, the largest size of a photo"""
+    if message.content_type == ContentType.PHOTO:
+        file = message.photo[-1]
+    else:
+        file = getattr(message, message.content_type)
+    return file.file_id, file.file_unique_id
+
+
+class MediaStore:
+    """
+    Media files stored once for every message that has them, found by Telegram's file_unique_id.
+
+    Messages keep the id of the file in `MessageData.media_id`. File ids are encrypted with
+    a key derived from the bot token, as they are shared between connections, and the file_unique_id
+    is only stored as a keyed hash. Frequently seen files are cached, so storing them costs no query.
+    """
+
+    def __init__(self, token: str, maxsize: int = 10000, ttl: float = 3600) -> None:
+        self.encryptor: TextEncryptor = get_bot_encryptor(token)
+        self._key = hashlib.sha256(f"media:{token}".encode()).digest()
+
+        self.ids: TTLCache[bytes, int] = TTLCache(maxsize=maxsize, ttl=ttl)  # Unique hash -> id
+        self.files: TTLCache[int, str] = TTLCache(maxsize=maxsize, ttl=ttl)  # Id -> file id
+
+    def unique_hash(self, file_unique_id: str) -> bytes:
+        return hmac.new(self._key, file_unique_id.encode(), hashlib.sha256).digest()
+
+    async def put(self, repo: "Repo", file_unique_id: str, file_id: str) -> int:
+        """Returns the id of the file, storing it when it is not stored yet"""
+        unique_hash = self.unique_hash(file_unique_id)
+
+        media_id = self.ids.get(unique_hash)
+        if media_id is None:
+            media_id = await repo.media.upsert(unique_hash, self.encryptor.encrypt(file_id))
+            self.ids.set(unique_hash, media_id)
+            self.files.set(media_id, file_id)
+
+        return media_id
+
+    async def put_message(self, repo: "Repo", message: Message) -> int:
+        file_id, file_unique_id = message_file(message)
+        return await self.put(repo, file_unique_id, file_id)
+
+    async def file_ids(self, repo: "Repo", messages: typing.Sequence[MessageData],
+                       encryptor: TextEncryptor) -> list[typing.Optional[str]]:
+        """
+        File ids of stored messages in their order.
+
+        Messages stored before the media table keep their file id encrypted with
+        the connection key in `sticker` or `media`.
+        """
+        files: dict[int, str] = {}
+        for media_id in {m.media_id for m in messages if m.media_id is not None}:
+            file_id = self.files.get(media_id)
+            if file_id is not None:
+                files[media_id] = file_id
+
+        missing = {m.media_id for m in messages if m.media_id is not None and m.media_id not in files}
+        if missing:
+            stored = await repo.media.get_many(missing)
+            for media, file_id in zip(stored, await self.encryptor.decrypt_many_async(m.file_id for m in stored)):
+                files[media.id] = file_id
+                self.files.set(media.id, file_id)
+
+        legacy = await encryptor.decrypt_many_async(
+            m.sticker if m.is_sticker else m.media for m in messages if m.media_id is None)
+        legacy = iter(legacy)
+
+        return [files.get(m.media_id) if m.media_id is not None else next(legacy) for m in messages]
@@ -0,0 +1,100 @@
+"""
+Converts `connection_id` of `messages` and `users` from hex strings to BINARY(32) digests
+and creates the indexes used by lookups.
+
+Rows are converted in batches of BATCH_SIZE, every batch in its own transaction,
+so the tables are never locked for long. Run it once with the bot stopped:
+
+    python -m repo.migrations.binary_connection_id
+"""
+import asyncio
+import logging
+
+from sqlalchemy import text, inspect, String
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from repo import Database
+from utils.config import config
+
+BATCH_SIZE = 5000
+
+INDEXES = {
+    "messages": "CREATE UNIQUE INDEX ix_messages_connection_message ON messages (connection_id, message_id)",
+    "users": "CREATE UNIQUE INDEX ix_users_connection_id ON users (connection_id)",
+}
+
+
+async def is_converted(engine: AsyncEngine, table: str) -> bool:
+    async with engine.connect() as conn:
+        columns = await conn.run_sync(lambda c: inspect(c).get_columns(table))
+
+    column = next(c for c in columns if c["name"] == "connection_id")
+    return not isinstance(column["type"], String)
+
+
+async def convert_rows(engine: AsyncEngine, table: str) -> int:
+    converted = 0
+    last_id = 0
+
+    while True:
+        async with engine.begin() as conn:
+            rows = (await conn.execute(
+                text(f"SELECT id, connection_id FROM {table} "
+                     f"WHERE connection_hash IS NULL AND connection_id IS NOT NULL AND id > :last_id "
+                     f"ORDER BY id LIMIT :limit"),
+                dict(last_id=last_id, limit=BATCH_SIZE)
+            )).all()
+
+            if not rows:
+                return converted
+
+            await conn.execute(text(f"UPDATE {table} SET connection_hash = :hash WHERE id = :id"),
+                               [dict(id=row.id, hash=bytes.fromhex(row.connection_id)) for row in rows])
+
+        converted += len(rows)
+        last_id = rows[-1].id
+        logging.info(f"{table}: {converted} rows converted")
+
+
+async def migrate_table(engine: AsyncEngine, table: str) -> None:
+    if await is_converted(engine, table):
+        logging.info(f"{table}: already converted, skipping")
+        return
+
+    async with engine.begin() as conn:
+        columns = await conn.run_sync(lambda c: [col["name"] for col in inspect(c).get_columns(table)])
+        if "connection_hash" not in columns:
+            await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN connection_hash BINARY(32)"))
+
+    await convert_rows(engine, table)
+
+    async with engine.begin() as conn:
+        if table == "messages":
+            # Duplicates would break the unique index, the latest copy of a message wins
+            result = await conn.execute(text(
+                "DELETE FROM messages WHERE id NOT IN (SELECT id FROM ("
+                "SELECT MAX(id) AS id FROM messages GROUP BY connection_hash, message_id) AS latest)"
+            ))
+            logging.info(f"messages: {result.rowcount} duplicate rows removed")
+
+        await conn.execute(text(f"ALTER TABLE {table} DROP COLUMN connection_id"))
+        await conn.execute(text(f"ALTER TABLE {table} RENAME COLUMN connection_hash TO connection_id"))
+        await conn.execute(text(INDEXES[table]))
+
+    logging.info(f"{table}: done")
+
+
+async def main() -> None:
+    db = Database(url=config.DATABASE.url)
+
+    try:
+        for table in ("users", "messages"):
+            await migrate_table(db.engine, table)
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format="[%(asctime)s][%(levelname)s][%(module)s] - %(message)s")
+    asyncio.run(main())
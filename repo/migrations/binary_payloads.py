@@ -0,0 +1,62 @@
+"""
+Stores encrypted payloads of `messages` (message, sticker, media) in binary columns.
+
+Run it once with the bot stopped before updating, new payloads are binary envelopes
+that text columns can't hold:
+
+    python -m repo.migrations.binary_payloads
+
+Payloads stored as base64 Fernet tokens stay readable. They are converted to envelopes by the bot
+in the background (`reencode` in the `[STORAGE]` section) or right away with `--convert`.
+"""
+import argparse
+import asyncio
+import logging
+
+from sqlalchemy import text, inspect, String
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from repo import Database
+from repo.reencode import PayloadReencoder
+from utils.config import config
+
+COLUMNS = ("message", "sticker", "media")
+
+
+async def text_columns(engine: AsyncEngine) -> list[str]:
+    async with engine.connect() as conn:
+        columns = await conn.run_sync(lambda c: inspect(c).get_columns("messages"))
+
+    return [c["name"] for c in columns if c["name"] in COLUMNS and isinstance(c["type"], String)]
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--convert", action="store_true", help="Convert legacy payloads to envelopes now")
+    args = parser.parse_args()
+
+    db = Database(url=config.DATABASE.url)
+
+    try:
+        columns = await text_columns(db.engine)
+
+        # SQLite columns take any value, their declared type doesn't matter
+        if columns and db.engine.dialect.name != "sqlite":
+            async with db.engine.begin() as conn:
+                await conn.execute(text("ALTER TABLE messages " + ", ".join(f"MODIFY {c} BLOB" for c in columns)))
+            logging.info(f"messages: {', '.join(columns)} converted to BLOB")
+        else:
+            logging.info("messages: payload columns are already binary, skipping")
+
+        if args.convert:
+            await PayloadReencoder(db, batch_size=5000, batch_pause_ms=0).run()
+
+        logging.info("done")
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format="[%(asctime)s][%(levelname)s][%(module)s] - %(message)s")
+    asyncio.run(main())
@@ -0,0 +1,45 @@
+"""
+Adds the `media` table and `messages.media_id` referring to it.
+
+Files of messages stored before stay in `sticker` and `media`, they can't be moved
+as neither the connection key nor the file_unique_id is known:
+
+    python -m repo.migrations.media_table
+"""
+import asyncio
+import logging
+
+from sqlalchemy import text, inspect
+
+from repo import Database
+from repo.modules.media import MediaData
+from utils.config import config
+
+
+async def main() -> None:
+    db = Database(url=config.DATABASE.url)
+
+    try:
+        async with db.engine.connect() as conn:
+            columns = await conn.run_sync(lambda c: [col["name"] for col in inspect(c).get_columns("messages")])
+            indexes = await conn.run_sync(lambda c: [i["name"] for i in inspect(c).get_indexes("messages")])
+
+        if "media_id" not in columns:
+            async with db.engine.begin() as conn:
+                await conn.execute(text("ALTER TABLE messages ADD COLUMN media_id INTEGER"))
+        if "ix_messages_media_id" not in indexes:
+            async with db.engine.begin() as conn:
+                await conn.execute(text("CREATE INDEX ix_messages_media_id ON messages (media_id)"))
+
+        async with db.engine.begin() as conn:
+            await conn.run_sync(lambda c: MediaData.__table__.create(c, checkfirst=True))
+
+        logging.info("done")
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format="[%(asctime)s][%(levelname)s][%(module)s] - %(message)s")
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+"""
+Adds `messages.created_at` used by retention.
+
+Existing messages get the migration time as their creation time, so they are kept
+for a full retention period. Rows are updated in batches of BATCH_SIZE:
+
+    python -m repo.migrations.message_created_at
+"""
+import asyncio
+import datetime
+import logging
+
+from sqlalchemy import text, inspect
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from repo import Database
+from utils.config import config
+
+BATCH_SIZE = 5000
+
+
+async def get_columns(engine: AsyncEngine, table: str) -> list[str]:
+    async with engine.connect() as conn:
+        return await conn.run_sync(lambda c: [col["name"] for col in inspect(c).get_columns(table)])
+
+
+async def fill_created_at(engine: AsyncEngine) -> int:
+    now = datetime.datetime.utcnow()
+    filled = 0
+    last_id = 0
+
+    while True:
+        async with engine.begin() as conn:
+            ids = (await conn.execute(
+                text("SELECT id FROM messages WHERE created_at IS NULL AND id > :last_id ORDER BY id LIMIT :limit"),
+                dict(last_id=last_id, limit=BATCH_SIZE)
+            )).scalars().all()
+
+            if not ids:
+                return filled
+
+            await conn.execute(text("UPDATE messages SET created_at = :now WHERE id >= :first AND id <= :last "
+                                    "AND created_at IS NULL"),
+                               dict(now=now, first=ids[0], last=ids[-1]))
+
+        filled += len(ids)
+        last_id = ids[-1]
+        logging.info(f"messages: {filled} rows filled")
+
+
+async def main() -> None:
+    db = Database(url=config.DATABASE.url)
+
+    try:
+        if "created_at" not in await get_columns(db.engine, "messages"):
+            async with db.engine.begin() as conn:
+                await conn.execute(text("ALTER TABLE messages ADD COLUMN created_at DATETIME"))
+
+        await fill_created_at(db.engine)
+
+        async with db.engine.connect() as conn:
+            indexes = await conn.run_sync(lambda c: [i["name"] for i in inspect(c).get_indexes("messages")])
+        if "ix_messages_created_at" not in indexes:
+            async with db.engine.begin() as conn:
+                await conn.execute(text("CREATE INDEX ix_messages_created_at ON messages (created_at)"))
+
+        logging.info("done")
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format="[%(asctime)s][%(levelname)s][%(module)s] - %(message)s")
+    asyncio.run(main())
@@ -0,0 +1,40 @@
+"""
+Adds `messages.version` and the `message_versions` table used by the edit history.
+
+Messages edited before the migration start their history with the version they have now:
+
+    python -m repo.migrations.message_versions
+"""
+import asyncio
+import logging
+
+from sqlalchemy import text, inspect
+
+from repo import Database
+from repo.modules.versions import VersionData
+from utils.config import config
+
+
+async def main() -> None:
+    db = Database(url=config.DATABASE.url)
+
+    try:
+        async with db.engine.connect() as conn:
+            columns = await conn.run_sync(lambda c: [col["name"] for col in inspect(c).get_columns("messages")])
+
+        if "version" not in columns:
+            async with db.engine.begin() as conn:
+                await conn.execute(text("ALTER TABLE messages ADD COLUMN version INTEGER DEFAULT 0"))
+
+        async with db.engine.begin() as conn:
+            await conn.run_sync(lambda c: VersionData.__table__.create(c, checkfirst=True))
+
+        logging.info("done")
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format="[%(asctime)s][%(levelname)s][%(module)s] - %(message)s")
+    asyncio.run(main())
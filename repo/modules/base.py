@@ -1,20 +1,50 @@
 import abc
 import typing
 
+from sqlalchemy import Table, Column, Insert
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import Session
 
 Base = declarative_base()
 
 
+def upsert(dialect: str, table: Table, index_elements: typing.Sequence[Column] = (),
+           update: typing.Sequence[str] = ()) -> Insert:
+    """
+    INSERT that doesn't fail on a duplicate key, for MySQL and SQLite.
+
+    Without `update` duplicates are skipped (a no-op ON DUPLICATE KEY UPDATE / ON CONFLICT DO NOTHING),
+    otherwise the `update` columns of the stored row are set to the inserted values. INSERT IGNORE
+    is not used, it turns every error into a warning, not only duplicate keys. SQLite needs
+    `index_elements` of the unique index to update. Values are given to execute(),
+    a list of them makes a multi-row insert.
+    """
+    if dialect == "mysql":
+        query = mysql.insert(table)
+        if not update:
+            key = next(iter(table.primary_key.columns))
+            return query.on_duplicate_key_update({key.key: key})
+        return query.on_duplicate_key_update({c: query.inserted[c] for c in update})
+
+    query = sqlite.insert(table)
+    if not update:
+        return query.on_conflict_do_nothing(index_elements=index_elements or None)
+    return query.on_conflict_do_update(index_elements=index_elements, set_={c: query.excluded[c] for c in update})
+
+
 class BaseRepo(abc.ABC):
     def __init__(self, s) -> None:
-        self._s: Session = s
+        self._s: AsyncSession = s
+
+    @property
+    def dialect(self) -> str:
+        return self._s.bind.dialect.name
 
     @abc.abstractmethod
-    def get(self, **kwargs) -> typing.Optional[Base]:
+    async def get(self, **kwargs) -> typing.Optional[Base]:
         pass
 
     @abc.abstractmethod
-    def add(self, obj: Base) -> bool:
+    async def add(self, obj: Base) -> bool:
         pass
@@ -0,0 +1,51 @@
+import datetime
+import typing
+
+from sqlalchemy import Column, Integer, LargeBinary, BINARY, DateTime, select, func
+from sqlalchemy.dialects import mysql
+
+from repo.modules.base import Base, BaseRepo, upsert
+
+
+class MediaData(Base):
+    """A file shared by every message that has it, see repo.media.MediaStore"""
+    __tablename__ = 'media'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    unique_hash = Column(BINARY(32), unique=True)  # HMAC-SHA256 of file_unique_id
+    file_id = Column(LargeBinary)  # Encrypted with the bot key, file ids are only valid for this bot
+
+    # Last time a message with the file was stored, orphans are pruned by it
+    seen_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+
+class MediaRepo(BaseRepo):
+    async def add(self, media: MediaData) -> bool:
+        await self.upsert(media.unique_hash, media.file_id)
+        return True
+
+    async def upsert(self, unique_hash: bytes, file_id: bytes) -> int:
+        """Stores a file unless it is already stored, returns its id in one statement either way"""
+        table = MediaData.__table__
+        values = dict(unique_hash=unique_hash, file_id=file_id, seen_at=datetime.datetime.utcnow())
+
+        if self.dialect == "mysql":
+            # LAST_INSERT_ID(id) makes the id of the existing row the last inserted id
+            query = mysql.insert(table).values(**values)
+            query = query.on_duplicate_key_update(id=func.last_insert_id(table.c.id), seen_at=query.inserted.seen_at)
+            result = await self._s.execute(query)
+            return result.lastrowid
+
+        query = upsert(self.dialect, table, [table.c.unique_hash], update=["seen_at"]).values(**values)
+        return (await self._s.execute(query.returning(table.c.id))).scalar_one()
+
+    async def get(self, id: int) -> typing.Optional[MediaData]:
+        return await self._s.get(MediaData, id)
+
+    async def get_many(self, ids: typing.Iterable[int]) -> list[MediaData]:
+        ids = list(ids)
+        if not ids:
+            return []
+
+        return list(await self._s.scalars(select(MediaData).where(MediaData.id.in_(ids))))
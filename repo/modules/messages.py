@@ -1,49 +1,158 @@
-import logging
+import datetime
 import typing
 
-from sqlalchemy import Column, Integer, String, BigInteger, Boolean, Text
+from aiogram.enums import ContentType
+from sqlalchemy import Column, Integer, BigInteger, Boolean, Text, LargeBinary, BINARY, DateTime, Index, select, update, delete
 
-from repo.modules.base import Base, BaseRepo
+from repo.modules.base import Base, BaseRepo, upsert
+
+if typing.TYPE_CHECKING:
+    from repo.buffer import MessageBuffer
 
 
 class MessageData(Base):
     __tablename__ = 'messages'
+    __table_args__ = (
+        Index('ix_messages_connection_message', 'connection_id', 'message_id', unique=True),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
 
-    connection_id = Column(String(4112))
+    connection_id = Column(BINARY(32))  # SHA-256 digest of business_connection_id
     message_id = Column(BigInteger)
-    message = Column(Text, default=None)
+    # Encrypted payloads, see utils.encryptor for the envelope format
+    message = Column(LargeBinary, default=None)
 
     is_sticker = Column(Boolean, default=False)
     is_media = Column(Boolean, default=False)
 
-    sticker = Column(Text, default=None)
+    sticker = Column(LargeBinary, default=None)
 
-    media = Column(Text, default=None)
+    media = Column(LargeBinary, default=None)
     media_type = Column(Text, default=None)
+    media_id = Column(Integer, default=None, index=True)  # File in the media table, sticker and media are legacy
+
+    version = Column(Integer, default=0)  # Edits seen, older versions are in message_versions
+
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+    @property
+    def content_type(self) -> str:
+        """Content type of the original message, as in Message.content_type"""
+        if self.is_media:
+            return self.media_type
+        if self.is_sticker:
+            return ContentType.STICKER
+        return ContentType.TEXT
+
+
+def to_row(message: MessageData) -> dict:
+    """Column values of a message for a Core INSERT"""
+    # Column defaults are only applied by the ORM on flush, every row of a
+    # multi-row INSERT must carry the same keys so they are filled in here
+    row = {}
+    for column in MessageData.__table__.columns:
+        if column.primary_key:
+            continue
+
+        value = getattr(message, column.key)
+        if value is None and column.default is not None:
+            if column.default.is_scalar:
+                value = column.default.arg
+            elif column.default.is_callable:
+                value = column.default.arg(None)
+        row[column.key] = value
+
+    return row
 
 
 class MessagesRepo(BaseRepo):
-    def __init__(self, s):
+    def __init__(self, s, buffer: typing.Optional["MessageBuffer"] = None):
         super().__init__(s)
+        self._buffer = buffer
+
+    async def add(self, message: MessageData) -> bool:
+        """Stores a message, a message that is already stored (a replayed update) is kept as it is"""
+        if self._buffer is not None:
+            self._buffer.put(message)
+            return True
+
+        await self._s.execute(upsert(self.dialect, MessageData.__table__).values(**to_row(message)))
+        return True
+
+    async def get(self, message_id: int, connection_id: bytes) -> typing.Optional[MessageData]:
+        pending = None
+        if self._buffer is not None:
+            pending = await self._buffer.get(connection_id=connection_id, message_id=message_id)
 
-    def add(self, message: MessageData) -> bool:
-        try:
-            self._s.add(message)
-            self._s.commit()
+        result = await self._s.scalars(select(MessageData)
+                                       .filter_by(message_id=message_id, connection_id=connection_id)
+                                       .limit(1))
+        stored = result.first()
+        if stored is None:
+            return pending
+
+        if pending is not None:
+            # A replayed update of a stored message was buffered, the stored row is the one to use
+            await self._buffer.discard(connection_id, [message_id])
+        return stored
+
+    async def get_many(self, connection_id: bytes, message_ids: typing.Iterable[int]) -> list[MessageData]:
+        """Returns stored messages in the order of `message_ids`, skipping unknown ids"""
+        message_ids = list(message_ids)
+        if not message_ids:
+            return []
+
+        pending = {}
+        if self._buffer is not None:
+            pending = {m.message_id: m for m in await self._buffer.get_many(connection_id, message_ids)}
+
+        result = await self._s.scalars(select(MessageData)
+                                       .where(MessageData.connection_id == connection_id,
+                                              MessageData.message_id.in_(message_ids)))
+        found = {m.message_id: m for m in result}
+
+        # Rows in the database win over replayed updates buffered again
+        shadowed = [i for i in pending if i in found]
+        if shadowed:
+            await self._buffer.discard(connection_id, shadowed)
+        found.update({i: m for i, m in pending.items() if i not in found})
+
+        return [found[i] for i in message_ids if i in found]
+
+    async def update(self, connection_id: bytes, message_id: int, **values) -> None:
+        """Changes a stored message with one statement, pending messages of the buffer are changed in memory"""
+        if self._buffer is not None and await self._buffer.update(connection_id, message_id, values):
+            return
+
+        await self._s.execute(update(MessageData)
+                              .where(MessageData.connection_id == connection_id,
+                                     MessageData.message_id == message_id)
+                              .values(**values)
+                              .execution_options(synchronize_session=False))
+
+    async def delete(self, message: MessageData) -> bool:
+        if self._buffer is not None and await self._buffer.discard(message.connection_id, [message.message_id]):
             return True
-        except Exception as e:
-            logging.error(e)
-            return False
 
-    def get(self, message_id: int, connection_id: str) -> typing.Optional[MessageData]:
-        return self._s.query(MessageData).filter_by(message_id=message_id, connection_id=connection_id).first()
+        await self._s.delete(message)
+
+    async def delete_many(self, connection_id: bytes, message_ids: typing.Iterable[int]) -> int:
+        message_ids = list(message_ids)
+        if not message_ids:
+            return 0
+
+        deleted = 0
+        if self._buffer is not None:
+            deleted = await self._buffer.discard(connection_id, message_ids)
+
+        result = await self._s.execute(delete(MessageData)
+                                       .where(MessageData.connection_id == connection_id,
+                                              MessageData.message_id.in_(message_ids)))
+        return deleted + result.rowcount
 
-    def delete(self, message: MessageData) -> bool:
-        self._s.delete(message)
-        self._s.commit()
+    async def delete_by_cid(self, connection_id) -> bool:
+        if self._buffer is not None:
+            await self._buffer.discard_connection(connection_id)
 
-    def delete_by_cid(self, connection_id) -> bool:
-        self._s.query(MessageData).filter(MessageData.connection_id == connection_id).delete()
-        self._s.commit()
+        await self._s.execute(delete(MessageData).where(MessageData.connection_id == connection_id))
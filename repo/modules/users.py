@@ -1,48 +1,99 @@
-import logging
 import typing
 
-from sqlalchemy import Column, String, BigInteger
+from sqlalchemy import Column, String, BigInteger, BINARY, select, update, delete, func
+from sqlalchemy.dialects import mysql
 
-from repo.modules.base import Base, BaseRepo
+from repo.modules.base import Base, BaseRepo, upsert
+
+if typing.TYPE_CHECKING:
+    from repo.cache import UsersCache
 
 
 class UserData(Base):
     __tablename__ = 'users'
 
     id = Column(BigInteger, primary_key=True)
-    connection_id = Column(String(1028), unique=True)
+    connection_id = Column(BINARY(32), unique=True)  # SHA-256 digest of business_connection_id
     channel_id = Column(BigInteger)
     language = Column(String(4), default="en")
 
 
 class UsersRepo(BaseRepo):
-    def __init__(self, s) -> None:
+    def __init__(self, s, cache: typing.Optional["UsersCache"] = None) -> None:
         super().__init__(s)
+        self._cache = cache
+
+    async def add(self, user: UserData) -> bool:
+        """Registers a user with one statement, returns False when the user or the connection is already registered"""
+        self.invalidate(connection_id=user.connection_id)
+
+        table = UserData.__table__
+        values = {c.key: getattr(user, c.key) for c in table.columns if getattr(user, c.key) is not None}
+
+        if self.dialect == "mysql":
+            # Rows found but not changed count as affected, LAST_INSERT_ID(id) tells a duplicate apart:
+            # the last inserted id is 0 after an insert into a table without auto increment
+            query = mysql.insert(table).values(**values)
+            result = await self._s.execute(query.on_duplicate_key_update(id=func.last_insert_id(table.c.id)))
+            return result.lastrowid == 0
+
+        result = await self._s.execute(upsert(self.dialect, table).values(**values))
+        return result.rowcount > 0
+
+    async def get(self, id: int) -> typing.Optional[UserData]:
+        if self._cache is not None:
+            user = self._cache.get(id)
+            if user is not None:
+                return user
+
+        user = await self._s.get(UserData, id)
+        if user is not None and self._cache is not None:
+            self._cache.put(user)
+
+        return user
+
+    async def get_by_connection(self, connection_id: bytes) -> typing.Optional[UserData]:
+        if self._cache is not None:
+            user = self._cache.get_by_connection(connection_id)
+            if user is not None:
+                return user
+            if self._cache.is_unknown(connection_id):
+                return None
+
+        result = await self._s.scalars(select(UserData).filter_by(connection_id=connection_id).limit(1))
+        user = result.first()
+        if self._cache is not None:
+            if user is not None:
+                self._cache.put(user)
+            else:
+                self._cache.put_unknown(connection_id)
+
+        return user
 
-    def add(self, user: UserData) -> bool:
-        s = self.get(user.id)
-        if s is not None:
-            return False
+    def is_unknown(self, connection_id: bytes) -> bool:
+        """Whether no user was found for the connection recently, not counted as a cache lookup"""
+        return self._cache is not None and self._cache.unknown.peek(connection_id) is not None
 
-        try:
-            self._s.add(user)
-            self._s.commit()
-            return True
-        except Exception as e:
-            logging.error(e)
-            return False
+    def notify_unknown(self, connection_id: bytes) -> bool:
+        """Whether the notice that the bot has to be connected again has to be sent, see UsersCache.notify_unknown"""
+        return self._cache is None or self._cache.notify_unknown(connection_id)
 
-    def get(self, id: int) -> typing.Optional[UserData]:
-        return self._s.query(UserData).get({"id": id})
+    def invalidate(self, user_id: typing.Optional[int] = None, connection_id: typing.Optional[bytes] = None) -> None:
+        if self._cache is not None:
+            self._cache.invalidate(user_id=user_id, connection_id=connection_id)
 
-    def get_by_connection(self, connection_id: str) -> typing.Optional[UserData]:
-        return self._s.query(UserData).filter_by(connection_id=connection_id).first()
+    async def update_connection_id(self, user: UserData, connection_id: bytes) -> bool:
+        self.invalidate(user_id=user.id, connection_id=user.connection_id)
+        self.invalidate(connection_id=connection_id)
 
-    def update_connection_id(self, user: UserData, connection_id: str) -> bool:
-        user.connection_id = connection_id
+        await self._s.execute(update(UserData)
+                              .where(UserData.id == user.id)
+                              .values(connection_id=connection_id)
+                              .execution_options(synchronize_session=False))
 
-        self._s.commit()
+    async def delete(self, user: UserData) -> bool:
+        self.invalidate(user_id=user.id, connection_id=user.connection_id)
 
-    def delete(self, user: UserData) -> bool:
-        self._s.delete(user)
-        self._s.commit()
+        await self._s.execute(delete(UserData)
+                              .where(UserData.id == user.id)
+                              .execution_options(synchronize_session=False))
@@ -0,0 +1,98 @@
+import datetime
+import typing
+
+from sqlalchemy import Column, Integer, BigInteger, Boolean, LargeBinary, BINARY, DateTime, Index, select, delete, func
+
+from repo.modules.base import Base, BaseRepo
+
+
+class VersionData(Base):
+    """
+    A version of an edited message.
+
+    Version 0 is the original message. Snapshots hold the full text, other versions
+    a delta against the previous one, see utils.history for the format.
+    """
+    __tablename__ = 'message_versions'
+    __table_args__ = (
+        Index('ix_message_versions_message', 'connection_id', 'message_id', 'version', unique=True),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    connection_id = Column(BINARY(32))  # SHA-256 digest of business_connection_id
+    message_id = Column(BigInteger)
+    version = Column(Integer)
+
+    is_snapshot = Column(Boolean, default=False)
+    # Encrypted payloads, media is only set in versions where it changed
+    payload = Column(LargeBinary)
+    media = Column(LargeBinary, default=None)
+
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+
+class VersionsRepo(BaseRepo):
+    async def add(self, version: VersionData) -> bool:
+        self._s.add(version)
+        return True
+
+    def add_many(self, versions: typing.Iterable[VersionData]) -> None:
+        """Adds versions to the session, they are inserted with the next flush"""
+        self._s.add_all(versions)
+
+    async def get(self, connection_id: bytes, message_id: int, version: int) -> typing.Optional[VersionData]:
+        result = await self._s.scalars(select(VersionData)
+                                       .filter_by(connection_id=connection_id, message_id=message_id, version=version)
+                                       .limit(1))
+        return result.first()
+
+    async def chain(self, connection_id: bytes, message_id: int,
+                    version: typing.Optional[int] = None) -> list[VersionData]:
+        """
+        Versions of a message ordered by version.
+
+        With `version` only the versions needed to rebuild it are returned,
+        starting from the closest snapshot before it.
+        """
+        query = (select(VersionData)
+                 .where(VersionData.connection_id == connection_id, VersionData.message_id == message_id)
+                 .order_by(VersionData.version))
+
+        if version is not None:
+            snapshot = (select(func.max(VersionData.version))
+                        .where(VersionData.connection_id == connection_id,
+                               VersionData.message_id == message_id,
+                               VersionData.is_snapshot.is_(True),
+                               VersionData.version <= version)
+                        .scalar_subquery())
+            query = query.where(VersionData.version >= snapshot, VersionData.version <= version)
+
+        return list(await self._s.scalars(query))
+
+    async def chains(self, connection_id: bytes, message_ids: typing.Iterable[int]) -> dict[int, list[VersionData]]:
+        """Versions of many messages with one query, by message id and ordered by version"""
+        message_ids = list(message_ids)
+        if not message_ids:
+            return {}
+
+        chains: dict[int, list[VersionData]] = {}
+        for row in await self._s.scalars(select(VersionData)
+                                         .where(VersionData.connection_id == connection_id,
+                                                VersionData.message_id.in_(message_ids))
+                                         .order_by(VersionData.message_id, VersionData.version)):
+            chains.setdefault(row.message_id, []).append(row)
+        return chains
+
+    async def delete_many(self, connection_id: bytes, message_ids: typing.Iterable[int]) -> int:
+        message_ids = list(message_ids)
+        if not message_ids:
+            return 0
+
+        result = await self._s.execute(delete(VersionData)
+                                       .where(VersionData.connection_id == connection_id,
+                                              VersionData.message_id.in_(message_ids)))
+        return result.rowcount
+
+    async def delete_by_cid(self, connection_id: bytes) -> None:
+        await self._s.execute(delete(VersionData).where(VersionData.connection_id == connection_id))
@@ -0,0 +1,97 @@
+import asyncio
+import contextlib
+import logging
+import typing
+
+from sqlalchemy import String, select, update, bindparam, literal, or_
+
+from repo.modules.messages import MessageData
+from utils.encryptor import LEGACY_PREFIX, is_legacy, to_envelope
+
+if typing.TYPE_CHECKING:
+    from repo.repo import Database
+
+PAYLOAD_COLUMNS = (MessageData.message, MessageData.sticker, MessageData.media)
+
+# Envelopes start with the version byte, only rows with a base64 token in some column are read
+# The pattern is bound as text, SQLite does not match text values against a binary pattern
+LEGACY_ROWS = or_(*(column.like(literal(LEGACY_PREFIX.decode() + "%", String())) for column in PAYLOAD_COLUMNS))
+
+
+class PayloadReencoder:
+    """
+    Background task that converts payloads stored as base64 Fernet tokens to binary envelopes.
+
+    The key is not needed, only the encoding of a token changes. Messages with legacy payloads
+    are read once by primary key in batches of `batch_size`, each batch in its own short
+    transaction, converted messages are not read again. A value is only replaced if it was
+    not changed since it was read.
+    """
+
+    def __init__(self, db: "Database", batch_size: int = 1000, batch_pause_ms: int = 100) -> None:
+        self.db = db
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause_ms / 1000
+
+        self.converted = 0  # Values converted since start
+        self._task: typing.Optional[asyncio.Task] = None
+
+    async def _convert_batch(self, last_id: int) -> typing.Optional[int]:
+        """Converts legacy messages after `last_id`, returns the last converted id or None when there are no more"""
+        async with self.db.session() as session:
+            rows = (await session.execute(select(MessageData.id, *PAYLOAD_COLUMNS)
+                                          .where(MessageData.id > last_id, LEGACY_ROWS)
+                                          .order_by(MessageData.id)
+                                          .limit(self.batch_size))).all()
+            if not rows:
+                return None
+
+            for i, column in enumerate(PAYLOAD_COLUMNS, 1):
+                changes = [dict(row_id=row[0], old=row[i], new=to_envelope(row[i]))
+                           for row in rows if row[i] is not None and is_legacy(row[i])]
+                if not changes:
+                    continue
+
+                # Core statement on the table, an ORM one would be a bulk update by primary key.
+                # Old values are compared as they were read, SQLite keeps legacy tokens as text.
+                table = MessageData.__table__
+                old = bindparam("old", type_=String())
+                await session.execute(update(table)
+                                      .where(table.c.id == bindparam("row_id"), table.c[column.key] == old)
+                                      .values({column.key: bindparam("new")}),
+                                      changes)
+                self.converted += len(changes)
+
+            await session.commit()
+            return rows[-1][0]
+
+    async def run(self) -> int:
+        """Converts every legacy payload, returns the number of converted values"""
+        converted = self.converted
+        last_id = 0
+
+        while True:
+            last_id = await self._convert_batch(last_id)
+            if last_id is None:
+                break
+            await asyncio.sleep(self.batch_pause)
+
+        logging.info(f"Payloads: {self.converted - converted} legacy values converted to envelopes")
+        return self.converted - converted
+
+    async def _run(self) -> None:
+        try:
+            await self.run()
+        except Exception as e:
+            logging.exception(f"Failed to convert legacy payloads: {e}")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
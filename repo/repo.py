@@ -1,27 +1,74 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import typing
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 
 from repo.modules.base import Base
+from repo.modules.media import MediaRepo
 from repo.modules.messages import MessagesRepo
 from repo.modules.users import UsersRepo
+from repo.modules.versions import VersionsRepo
+
+if typing.TYPE_CHECKING:
+    from repo.buffer import MessageBuffer
+    from repo.cache import UsersCache
+
+
+class Database:
+    def __init__(self, url: str, pool_size: int = 10, max_overflow: int = 20,
+                 pool_recycle: int = 3600, pool_pre_ping: bool = True) -> None:
+        pool_args = {}
+        if make_url(url).get_backend_name() != "sqlite":
+            pool_args = dict(pool_size=pool_size, max_overflow=max_overflow)
+
+        self.engine = create_async_engine(url,
+                                          pool_recycle=pool_recycle,
+                                          pool_pre_ping=pool_pre_ping,
+                                          **pool_args)
+
+        self._Session = async_sessionmaker(bind=self.engine, expire_on_commit=False)
+
+    def session(self) -> AsyncSession:
+        return self._Session()
+
+    async def create_tables(self) -> None:
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    async def close(self) -> None:
+        await self.engine.dispose()
 
 
 class Repo:
-    def __init__(self, username: str, password: str, ip: str, port: int, db: str) -> None:
-        self.engine = create_engine(f'mysql+pymysql://{username}:{password}@{ip}:{port}/{db}')
+    """Unit of work bound to a single session, committed by DatabaseMiddleware or by handlers before sending"""
 
-        self._Session = sessionmaker(bind=self.engine)
-        self.session = self._Session()
+    def __init__(self, session: AsyncSession, buffer: typing.Optional["MessageBuffer"] = None,
+                 users_cache: typing.Optional["UsersCache"] = None) -> None:
+        self.session = session
+        self.buffer = buffer
+        self.users_cache = users_cache
 
-        Base.metadata.create_all(self.engine)
+    async def save(self) -> None:
+        await self.session.flush()
 
-    def save(self) -> None:
-        self.session.commit()
+    async def commit(self) -> None:
+        await self.session.commit()
+
+    async def rollback(self) -> None:
+        await self.session.rollback()
 
     @property
     def users(self) -> UsersRepo:
-        return UsersRepo(s=self.session)
+        return UsersRepo(s=self.session, cache=self.users_cache)
 
     @property
     def messages(self) -> MessagesRepo:
-        return MessagesRepo(s=self.session)
+        return MessagesRepo(s=self.session, buffer=self.buffer)
+
+    @property
+    def media(self) -> MediaRepo:
+        return MediaRepo(s=self.session)
+
+    @property
+    def versions(self) -> VersionsRepo:
+        return VersionsRepo(s=self.session)
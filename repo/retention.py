@@ -0,0 +1,99 @@
+import asyncio
+import contextlib
+import datetime
+import logging
+import typing
+
+from sqlalchemy import select, delete, exists
+
+from repo.modules.media import MediaData
+from repo.modules.messages import MessageData
+from repo.modules.versions import VersionData
+
+if typing.TYPE_CHECKING:
+    from repo.repo import Database
+
+
+class RetentionPruner:
+    """
+    Background task that deletes messages older than the retention period.
+
+    Rows are deleted in batches of `batch_size` by primary key, each batch in its own short transaction.
+    Versions of edited messages are kept for the same period. Media files no message refers to
+    are deleted once they were not seen for `media_grace` seconds.
+    """
+
+    def __init__(self, db: "Database", days: int = 0, interval: int = 3600,
+                 batch_size: int = 1000, batch_pause_ms: int = 100, media_grace: float = 7200) -> None:
+        self.db = db
+        self.days = days
+        self.media_grace = media_grace
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause_ms / 1000
+
+        self.pruned = 0  # Rows pruned since start
+        self._task: typing.Optional[asyncio.Task] = None
+
+    async def _delete_batches(self, query, model=MessageData) -> int:
+        pruned = 0
+
+        while True:
+            async with self.db.session() as session:
+                ids = list(await session.scalars(query.limit(self.batch_size)))
+                if not ids:
+                    return pruned
+
+                await session.execute(delete(model)
+                                      .where(model.id.in_(ids))
+                                      .execution_options(synchronize_session=False))
+                await session.commit()
+
+            pruned += len(ids)
+            await asyncio.sleep(self.batch_pause)
+
+    async def _prune(self, model, now: datetime.datetime) -> int:
+        if self.days <= 0:
+            return 0
+
+        return await self._delete_batches(
+            select(model.id).where(model.created_at < now - datetime.timedelta(days=self.days)),
+            model
+        )
+
+    async def prune(self) -> int:
+        now = datetime.datetime.utcnow()
+
+        pruned = await self._prune(MessageData, now)
+        versions = await self._prune(VersionData, now)
+        media = await self._delete_batches(
+            select(MediaData.id)
+            .where(MediaData.seen_at < now - datetime.timedelta(seconds=self.media_grace),
+                   ~exists().where(MessageData.media_id == MediaData.id)),
+            MediaData
+        )
+
+        self.pruned += pruned
+        logging.info(f"Retention: {pruned} messages, {versions} versions and {media} media files pruned "
+                     f"({self.pruned} messages since start)")
+        return pruned
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.prune()
+            except Exception as e:
+                logging.exception(e)
+
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
@@ -1,7 +1,11 @@
+import os
 from configparser import ConfigParser
 from typing import Dict, Any
 
-from pydantic import BaseModel, SecretStr
+from pydantic import BaseModel, SecretStr, model_validator
+
+# Pooled connections kept for the buffer, the retention task and the re-encoder, exports need one each
+BACKGROUND_CONNECTIONS = 3
 
 
 def parse_config_file(config_file: str) -> Dict[str, Dict[str, Any]]:
@@ -36,11 +40,145 @@ class DatabaseConfig(BaseModel):
     ip: str
     port: int
     db: str
+    driver: str = "mysql+aiomysql"
+    dsn: str = ""  # Full SQLAlchemy url, overrides the fields above (e.g. sqlite+aiosqlite:///bot.db)
+
+    pool_size: int = 10
+    max_overflow: int = 20
+    pool_recycle: int = 3600
+    pool_pre_ping: bool = True
+
+    @property
+    def url(self) -> str:
+        if self.dsn:
+            return self.dsn
+        return f"{self.driver}://{self.username}:{self.password}@{self.ip}:{self.port}/{self.db}"
+
+
+class BufferConfig(BaseModel):
+    enabled: bool = False
+    max_rows: int = 500
+    interval_ms: int = 200
+
+
+class RateLimitConfig(BaseModel):
+    global_rate: float = 30
+    chat_rate: float = 1
+    chat_burst: int = 3
+    group_rate: float = 0.33
+    max_retries: int = 3
+
+
+class CacheConfig(BaseModel):
+    users_size: int = 10000
+    users_ttl: int = 600
+    unknown_size: int = 10000
+    unknown_ttl: int = 300  # Connections no user was found for are not looked up again for this long
+    notified_size: int = 10000
+    notified_ttl: int = 86400  # The notice about an unknown connection is sent once in this long
+    media_size: int = 10000
+    media_ttl: int = 3600
+
+
+class RetentionConfig(BaseModel):
+    days: int = 0  # 0 - keep messages forever
+    interval: int = 3600
+    batch_size: int = 1000
+    batch_pause_ms: int = 100
+
+
+class WebhookConfig(BaseModel):
+    enabled: bool = False
+    url: str = ""  # Public base url, the webhook is not registered when empty
+    path: str = "/webhook"
+    secret: str = ""
+    host: str = "127.0.0.1"
+    port: int = 8080
+
+
+class WorkersConfig(BaseModel):
+    count: int = 1  # More than 1 runs a supervisor with worker processes
+    health_interval: int = 10
+
+
+class DispatchConfig(BaseModel):
+    workers: int = 24  # Every worker holds a pooled connection while it handles an update
+    max_pending: int = 1000
+    max_per_connection: int = 200
+    admission_timeout: float = 5
+
+
+class MetricsConfig(BaseModel):
+    enabled: bool = False
+    host: str = "127.0.0.1"
+    port: int = 9100  # Worker processes listen on port + worker index
+    path: str = "/metrics"
+
+
+class TracingConfig(BaseModel):
+    enabled: bool = False
+    sample_rate: float = 0.1  # Share of updates whose every call is kept, others are only counted
+    slow_ms: float = 500  # Updates handled longer than this are dumped
+    slow_queries: int = 10  # Updates with at least this many queries are dumped
+    max_spans: int = 200
+    path: str = "slow_updates.jsonl"
+
+
+class DigestConfig(BaseModel):
+    enabled: bool = True
+    min_messages: int = 2  # Deletions of fewer text messages are notified one by one
+    window_ms: int = 0  # Collect deletions in a chat for this long before sending a digest
+
+
+class StorageConfig(BaseModel):
+    reencode: bool = False  # Convert payloads stored as base64 Fernet tokens to binary envelopes in the background
+    batch_size: int = 1000
+    batch_pause_ms: int = 100
+
+
+class HistoryConfig(BaseModel):
+    enabled: bool = True
+    snapshot_every: int = 10  # Every n-th version of an edited message is stored in full, others as deltas
+
+
+class LocationConfig(BaseModel):
+    window: int = 300  # Edits of a live location are notified once per window, 0 notifies every edit
+    max_tracked: int = 10000
+
+
+class ExportConfig(BaseModel):
+    enabled: bool = True
+    chunk_size: int = 500  # Messages read, decrypted and written at a time
+    concurrency: int = 1  # Exports running at once, every running export holds a pooled connection
 
 
 class Config(BaseModel):
     DATABASE: DatabaseConfig
     BOT: BotConfig
+    BUFFER: BufferConfig = BufferConfig()
+    RATE_LIMIT: RateLimitConfig = RateLimitConfig()
+    CACHE: CacheConfig = CacheConfig()
+    RETENTION: RetentionConfig = RetentionConfig()
+    WEBHOOK: WebhookConfig = WebhookConfig()
+    WORKERS: WorkersConfig = WorkersConfig()
+    DISPATCH: DispatchConfig = DispatchConfig()
+    METRICS: MetricsConfig = MetricsConfig()
+    TRACING: TracingConfig = TracingConfig()
+    DIGEST: DigestConfig = DigestConfig()
+    STORAGE: StorageConfig = StorageConfig()
+    HISTORY: HistoryConfig = HistoryConfig()
+    LOCATION: LocationConfig = LocationConfig()
+    EXPORT: ExportConfig = ExportConfig()
+
+    @model_validator(mode="after")
+    def check_pool(self) -> "Config":
+        capacity = self.DATABASE.pool_size + self.DATABASE.max_overflow
+        background = BACKGROUND_CONNECTIONS + (self.EXPORT.concurrency if self.EXPORT.enabled else 0)
+        if self.DISPATCH.workers + background > capacity:
+            raise ValueError(f"DISPATCH.workers ({self.DISPATCH.workers}) and EXPORT.concurrency need a pool "
+                             f"of at least {self.DISPATCH.workers + background} connections, "
+                             f"DATABASE.pool_size + max_overflow is {capacity}")
+        return self
 
 
-config = Config(**parse_config_file("config.ini"))
+config = Config(**parse_config_file(os.getenv("CONFIG", "config.ini")))
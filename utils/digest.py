@@ -0,0 +1,199 @@
+import asyncio
+import html
+import logging
+import re
+import typing
+
+from aiogram import Bot
+
+MESSAGE_LIMIT = 4096  # Characters of a message after entities parsing
+ENTITIES_LIMIT = 100  # Formatting entities of a message
+PART_RESERVE = 16  # Characters kept free in every message for the " (1/2)" part counter
+
+_TOKEN = re.compile(r"<(/?)([a-zA-Z][\w-]*)[^>]*>|&(?:#\d+|#x[0-9a-fA-F]+|\w+);|[^<&]+|[<&]")
+
+
+def text_length(text: str) -> int:
+    """Length as Telegram counts it, in UTF-16 code units"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def visible_length(html_text: str) -> int:
+    """Length of HTML text without its tags"""
+    length = 0
+    for match in _TOKEN.finditer(html_text):
+        if match.group(2) is None:
+            length += text_length(html.unescape(match.group(0)))
+    return length
+
+
+def _cut(text: str, limit: int) -> str:
+    """The longest start of `text` that fits into `limit`, cut at a line or word end when possible"""
+    size = 0
+    end = 0
+    for end, char in enumerate(text):
+        size += text_length(char)
+        if size > limit:
+            break
+    else:
+        return text
+
+    piece = text[:end]
+    for separator in ("\n", " "):
+        position = piece.rfind(separator)
+        if position >= len(piece) // 2:
+            return piece[:position + 1]
+    return piece
+
+
+def split_html(html_text: str, limit: int) -> list[tuple[str, int, int]]:
+    """
+    Splits HTML text into parts of at most `limit` visible characters.
+
+    Tags open at a split are closed at the end of the part and opened again in the next one,
+    so every part is valid on its own. Returns (part, visible length, opened tags) tuples.
+    """
+    parts = []
+    current: list[str] = []
+    length = 0
+    tags = 0
+    open_tags: list[tuple[str, str]] = []
+
+    def finish() -> None:
+        nonlocal current, length, tags
+        closing = "".join(f"</{name}>" for name, _ in reversed(open_tags))
+        parts.append(("".join(current) + closing, length, tags))
+
+        current = [tag for _, tag in open_tags]
+        length = 0
+        tags = len(open_tags)
+
+    for match in _TOKEN.finditer(html_text):
+        token = match.group(0)
+
+        if match.group(2) is not None:
+            name = match.group(2).lower()
+            if match.group(1):
+                for i in range(len(open_tags) - 1, -1, -1):
+                    if open_tags[i][0] == name:
+                        del open_tags[i]
+                        break
+            else:
+                open_tags.append((name, token))
+                tags += 1
+            current.append(token)
+            continue
+
+        # Entities like &amp; can't be cut
+        if token[0] == "&" and len(token) > 1:
+            size = text_length(html.unescape(token))
+            if length and length + size > limit:
+                finish()
+            current.append(token)
+            length += size
+            continue
+
+        while token:
+            piece = _cut(token, limit - length)
+            if not piece and not length:
+                piece = token[0]
+
+            if piece:
+                current.append(piece)
+                length += text_length(piece)
+                token = token[len(piece):]
+            if token:
+                finish()
+
+    if length or not parts:
+        finish()
+
+    return parts
+
+
+def pack(header: str, entries: typing.Iterable[str], limit: int = MESSAGE_LIMIT,
+         entities_limit: int = ENTITIES_LIMIT) -> list[str]:
+    """
+    Packs `entries` (HTML) into as few messages as possible.
+
+    Every message starts with `header` and quotes entries in expandable blockquotes.
+    Entries longer than a message are split between several blockquotes.
+    When there is more than one message, the header gets a part counter.
+    """
+    header_length = visible_length(header)
+    header_tags = header.count("<") - header.count("</")
+    room = limit - header_length - PART_RESERVE
+
+    messages: list[list[str]] = []
+    current: typing.Optional[list[str]] = None
+    length = 0
+    tags = 0
+
+    for entry in entries:
+        for part, part_length, part_tags in split_html(entry, room):
+            part_tags += 1  # The blockquote
+            if current is None or length + part_length > room or tags + part_tags > entities_limit - header_tags:
+                current = []
+                messages.append(current)
+                length = 0
+                tags = 0
+
+            current.append(f"<blockquote expandable>{part}</blockquote>")
+            length += part_length
+            tags += part_tags
+
+    if len(messages) == 1:
+        return [header + "".join(messages[0])]
+
+    return [f"{header} ({i}/{len(messages)})" + "".join(blocks) for i, blocks in enumerate(messages, 1)]
+
+
+class DeletionDigest:
+    """
+    Sends deleted messages as digests packed into as few messages as possible.
+
+    With `window_ms` entries for the same chat and header are collected for that long,
+    so deletions that come in several updates are sent together.
+    """
+
+    def __init__(self, min_messages: int = 2, window_ms: int = 0) -> None:
+        self.min_messages = min_messages
+        self.window_ms = window_ms
+
+        self._pending: dict[tuple[int, str], tuple[Bot, list[str]]] = {}
+        self._tasks: dict[tuple[int, str], asyncio.Task] = {}
+
+    async def send(self, bot: Bot, chat_id: int, header: str, entries: typing.Iterable[str]) -> None:
+        if not self.window_ms:
+            await self._send(bot, chat_id, header, list(entries))
+            return
+
+        key = (chat_id, header)
+        if key not in self._pending:
+            self._pending[key] = (bot, [])
+            self._tasks[key] = asyncio.create_task(self._send_later(key))
+        self._pending[key][1].extend(entries)
+
+    async def _send_later(self, key: tuple[int, str]) -> None:
+        await asyncio.sleep(self.window_ms / 1000)
+        await self._send_pending(key)
+
+    async def _send_pending(self, key: tuple[int, str]) -> None:
+        self._tasks.pop(key, None)
+        bot, entries = self._pending.pop(key)
+
+        try:
+            await self._send(bot, key[0], key[1], entries)
+        except Exception as e:
+            logging.exception(f"Failed to send a deletion digest to {key[0]}: {e}")
+
+    @staticmethod
+    async def _send(bot: Bot, chat_id: int, header: str, entries: list[str]) -> None:
+        for text in pack(header, entries):
+            await bot.send_message(chat_id=chat_id, text=text)
+
+    async def flush(self) -> None:
+        """Sends the collected digests right away"""
+        for key, task in list(self._tasks.items()):
+            task.cancel()
+            await self._send_pending(key)
@@ -1,8 +1,41 @@
+import asyncio
 import base64
+import functools
 import hashlib
+import typing
+import zlib
 
 from cryptography.fernet import Fernet
 
+from utils import tracing
+
+CIPHER_CACHE_SIZE = 4096  # Cached ciphers, one per business connection
+HASH_CACHE_SIZE = 4096  # Memoized connection hashes
+THREAD_BATCH_SIZE = 64  # Batches at least this large are processed in a worker thread
+
+# Stored values are envelopes: version byte, flags byte and the raw (not base64) Fernet token
+ENVELOPE_VERSION = 1
+FLAG_ZLIB = 0x01
+COMPRESS_THRESHOLD = 256  # Longer texts are compressed when it makes them shorter
+LEGACY_PREFIX = b"g"  # Base64 Fernet tokens stored before envelopes always start with "gAAAAA"
+
+Payload = typing.Union[str, bytes]
+
+
+def is_legacy(value: Payload) -> bool:
+    if isinstance(value, str):
+        return True
+    return value[:1] == LEGACY_PREFIX
+
+
+def to_envelope(value: Payload) -> bytes:
+    """Converts a legacy base64 Fernet token to an envelope, the key is not needed"""
+    if not is_legacy(value):
+        return value
+    if isinstance(value, str):
+        value = value.encode()
+    return bytes((ENVELOPE_VERSION, 0)) + base64.urlsafe_b64decode(value)
+
 
 class TextEncryptor:
     def __init__(self, key):
@@ -12,17 +45,81 @@ class TextEncryptor:
         self.cipher_suite = Fernet(base64.urlsafe_b64encode(key_bytes))
 
     def encrypt(self, plaintext):
-        plaintext_bytes = plaintext.encode('utf-8')
-        encrypted_bytes = self.cipher_suite.encrypt(plaintext_bytes)
-        return encrypted_bytes.decode('utf-8')
+        with tracing.span(tracing.CRYPTO, "encrypt"):
+            return self._encrypt(plaintext)
 
     def decrypt(self, ciphertext):
-        ciphertext_bytes = ciphertext.encode('utf-8')
-        decrypted_bytes = self.cipher_suite.decrypt(ciphertext_bytes)
+        with tracing.span(tracing.CRYPTO, "decrypt"):
+            return self._decrypt(ciphertext)
+
+    def _encrypt(self, plaintext: str) -> bytes:
+        plaintext_bytes = plaintext.encode('utf-8')
+
+        flags = 0
+        if len(plaintext_bytes) >= COMPRESS_THRESHOLD:
+            compressed = zlib.compress(plaintext_bytes)
+            if len(compressed) < len(plaintext_bytes):
+                plaintext_bytes = compressed
+                flags |= FLAG_ZLIB
+
+        token = self.cipher_suite.encrypt(plaintext_bytes)
+        return bytes((ENVELOPE_VERSION, flags)) + base64.urlsafe_b64decode(token)
+
+    def _decrypt(self, ciphertext: Payload) -> str:
+        if is_legacy(ciphertext):
+            if isinstance(ciphertext, str):
+                ciphertext = ciphertext.encode('utf-8')
+            return self.cipher_suite.decrypt(ciphertext).decode('utf-8')
+
+        version, flags = ciphertext[0], ciphertext[1]
+        if version != ENVELOPE_VERSION:
+            raise ValueError(f"Unknown envelope version {version}")
+
+        decrypted_bytes = self.cipher_suite.decrypt(base64.urlsafe_b64encode(ciphertext[2:]))
+        if flags & FLAG_ZLIB:
+            decrypted_bytes = zlib.decompress(decrypted_bytes)
         return decrypted_bytes.decode('utf-8')
 
+    def encrypt_many(self, plaintexts: typing.Iterable[typing.Optional[str]]) -> list[typing.Optional[bytes]]:
+        plaintexts = list(plaintexts)
+        with tracing.span(tracing.CRYPTO, f"encrypt_many [x{len(plaintexts)}]"):
+            return [self._encrypt(p) if p is not None else None for p in plaintexts]
+
+    def decrypt_many(self, ciphertexts: typing.Iterable[typing.Optional[Payload]]) -> list[typing.Optional[str]]:
+        ciphertexts = list(ciphertexts)
+        with tracing.span(tracing.CRYPTO, f"decrypt_many [x{len(ciphertexts)}]"):
+            return [self._decrypt(c) if c is not None else None for c in ciphertexts]
+
+    async def encrypt_many_async(self, plaintexts: typing.Iterable[typing.Optional[str]],
+                                 thread_batch_size: int = THREAD_BATCH_SIZE) -> list[typing.Optional[bytes]]:
+        plaintexts = list(plaintexts)
+        if len(plaintexts) < thread_batch_size:
+            return self.encrypt_many(plaintexts)
+
+        return await asyncio.to_thread(self.encrypt_many, plaintexts)
+
+    async def decrypt_many_async(self, ciphertexts: typing.Iterable[typing.Optional[Payload]],
+                                 thread_batch_size: int = THREAD_BATCH_SIZE) -> list[typing.Optional[str]]:
+        ciphertexts = list(ciphertexts)
+        if len(ciphertexts) < thread_batch_size:
+            return self.decrypt_many(ciphertexts)
+
+        return await asyncio.to_thread(self.decrypt_many, ciphertexts)
+
+
+@functools.lru_cache(maxsize=CIPHER_CACHE_SIZE)
+def get_encryptor(key: str) -> TextEncryptor:
+    """Returns a cached TextEncryptor, least recently used ones are evicted"""
+    return TextEncryptor(key=key)
+
+
+def get_bot_encryptor(token: str) -> TextEncryptor:
+    """Encryptor for data shared between connections, its key is derived from the bot token"""
+    return get_encryptor(hashlib.sha256(f"bot:{token}".encode()).hexdigest()[:32])
+
 
-def get_text_hash(text: str) -> str:
+@functools.lru_cache(maxsize=HASH_CACHE_SIZE)
+def get_text_hash(text: str) -> bytes:
     hash = hashlib.sha256()
     hash.update(text.encode())
-    return hash.hexdigest()
+    return hash.digest()
@@ -0,0 +1,146 @@
+import asyncio
+import contextlib
+import datetime
+import gzip
+import json
+import logging
+import os
+import tempfile
+import typing
+
+from aiogram import Bot
+from aiogram.types import FSInputFile
+from sqlalchemy import select
+
+from repo import Repo
+from repo.modules.messages import MessageData
+from utils.encryptor import get_encryptor, get_text_hash
+
+if typing.TYPE_CHECKING:
+    from repo.buffer import MessageBuffer
+    from repo.media import MediaStore
+    from repo.repo import Database
+    from utils.history import EditHistory
+
+
+class HistoryExporter:
+    """
+    Exports the stored messages of a connection as a gzipped JSONL document.
+
+    Exports run in background tasks, at most `concurrency` at once. Messages are read by
+    primary key, decrypted and written `chunk_size` at a time, so memory use doesn't depend
+    on the size of the history. Every chunk and the files and versions of its messages are
+    read in one short transaction, an export holds a pooled connection only meanwhile.
+    Files are written in a worker thread.
+    """
+
+    def __init__(self, db: "Database", media_store: "MediaStore", buffer: typing.Optional["MessageBuffer"] = None,
+                 edit_history: typing.Optional["EditHistory"] = None, chunk_size: int = 500,
+                 concurrency: int = 1) -> None:
+        self.db = db
+        self.media_store = media_store
+        self.buffer = buffer
+        self.edit_history = edit_history
+        self.chunk_size = chunk_size
+
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(concurrency)  # Shared by every user, exports wait for their turn
+
+    def start(self, bot: Bot, user_id: int, business_connection_id: str,
+              caption: typing.Callable[[int], str]) -> bool:
+        """Starts an export for the user, returns False when one is already running"""
+        if user_id in self._tasks:
+            return False
+
+        task = asyncio.create_task(self._run(bot, user_id, business_connection_id, caption))
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(user_id, None))
+        return True
+
+    async def _run(self, bot: Bot, user_id: int, business_connection_id: str,
+                   caption: typing.Callable[[int], str]) -> None:
+        fd, path = tempfile.mkstemp(suffix=".jsonl.gz")
+        os.close(fd)
+        try:
+            async with self._semaphore:
+                count = await self.export(business_connection_id, path)
+            filename = f"history-{datetime.date.today().isoformat()}.jsonl.gz"
+            await bot.send_document(chat_id=user_id, document=FSInputFile(path, filename=filename),
+                                    caption=caption(count))
+            logging.info(f"Export: {count} messages sent to {user_id}")
+        except Exception as e:
+            logging.exception(f"Failed to export the history of {user_id}: {e}")
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+    async def export(self, business_connection_id: str, path: str) -> int:
+        """Writes the stored messages of a connection to `path`, returns their number"""
+        connection_id = get_text_hash(business_connection_id)
+        encryptor = get_encryptor(business_connection_id)
+        count = 0
+
+        # Messages still waiting in the buffer would be missing
+        if self.buffer is not None:
+            await self.buffer.flush()
+
+        file = await asyncio.to_thread(gzip.open, path, "wt", encoding="utf-8")
+        try:
+            async with self.db.session() as session:
+                repo = Repo(session)
+                last_id = 0
+                while True:
+                    messages = list(await session.scalars(select(MessageData)
+                                                          .where(MessageData.connection_id == connection_id,
+                                                                 MessageData.id > last_id)
+                                                          .order_by(MessageData.id)
+                                                          .limit(self.chunk_size)))
+                    if not messages:
+                        break
+
+                    lines = await self._lines(repo, messages, encryptor)
+                    # The connection goes back to the pool while the chunk is written
+                    await session.commit()
+                    session.expunge_all()
+
+                    await asyncio.to_thread(file.writelines, lines)
+                    count += len(messages)
+                    last_id = messages[-1].id
+        finally:
+            await asyncio.to_thread(file.close)
+
+        return count
+
+    async def _lines(self, repo: Repo, messages: typing.Sequence[MessageData], encryptor) -> list[str]:
+        texts = await encryptor.decrypt_many_async(m.message for m in messages)
+        has_file = [m for m in messages if m.is_media or m.is_sticker]
+        files = dict(zip((m.message_id for m in has_file), await self.media_store.file_ids(repo, has_file, encryptor)))
+
+        chains = {}
+        edited = [m.message_id for m in messages if m.version]
+        if edited and self.edit_history is not None:
+            chains = await self.edit_history.chains(repo, messages[0].connection_id, edited, encryptor)
+
+        lines = []
+        for message, text in zip(messages, texts):
+            record = dict(message_id=message.message_id,
+                          type=message.content_type,
+                          text=text,
+                          file_id=files.get(message.message_id),
+                          created_at=message.created_at.isoformat() if message.created_at is not None else None)
+
+            versions = chains.get(message.message_id)
+            if versions:
+                record["versions"] = [dict(version=v.version, text=v.text, file_id=v.media,
+                                           created_at=v.created_at.isoformat() if v.created_at is not None else None)
+                                      for v in versions]
+
+            lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+
+        return lines
+
+    async def stop(self) -> None:
+        for task in list(self._tasks.values()):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
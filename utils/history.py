@@ -0,0 +1,131 @@
+import difflib
+import json
+import typing
+
+from repo import Repo
+from repo.modules.messages import MessageData
+from repo.modules.versions import VersionData
+from utils.encryptor import TextEncryptor
+
+# A delta is a JSON list of [start, end] ranges copied from the previous text and inserted strings:
+# "Hello world" -> "Hello, world!" is [[0, 5], ", ", [6, 11], "!"]
+Delta = list[typing.Union[list[int], str]]
+
+
+def make_delta(old: str, new: str) -> Delta:
+    delta: Delta = []
+    matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            delta.append([i1, i2])
+        elif tag in ("replace", "insert"):
+            delta.append(new[j1:j2])
+    return delta
+
+
+def apply_delta(old: str, delta: Delta) -> str:
+    return "".join(old[op[0]:op[1]] if isinstance(op, list) else op for op in delta)
+
+
+class Version(typing.NamedTuple):
+    version: int
+    text: str
+    media: typing.Optional[str]  # File id of the media the version had
+    created_at: typing.Any
+
+
+class EditHistory:
+    """
+    Keeps every version of edited messages.
+
+    Versions are stored as deltas against the previous version, every `snapshot_every`-th
+    version is stored in full, so rebuilding one never replays more than that many deltas.
+    The stored message itself always holds the newest version.
+    """
+
+    def __init__(self, snapshot_every: int = 10) -> None:
+        self.snapshot_every = max(snapshot_every, 1)
+
+    def record(self, repo: Repo, message: MessageData, encryptor: TextEncryptor,
+               old_text: typing.Optional[str], new_text: typing.Optional[str],
+               old_media: typing.Optional[str] = None, new_media: typing.Optional[str] = None) -> int:
+        """
+        Adds the new version of `message` to the session of `repo` and returns its number.
+
+        Nothing is queried, the versions are inserted with the next flush. The caller
+        stores the number in `MessageData.version` together with the new text.
+        """
+        old_text = old_text or ""
+        new_text = new_text or ""
+        versions = []
+
+        current = message.version or 0
+        if current == 0:
+            versions.append(VersionData(connection_id=message.connection_id, message_id=message.message_id,
+                                        version=0, is_snapshot=True, payload=encryptor.encrypt(old_text),
+                                        media=encryptor.encrypt(old_media) if old_media is not None else None))
+
+        version = current + 1
+        payload = new_text
+        is_snapshot = version % self.snapshot_every == 0
+        if not is_snapshot:
+            delta = json.dumps(make_delta(old_text, new_text), ensure_ascii=False, separators=(",", ":"))
+            # Rewritten texts are shorter in full
+            if len(delta) < len(new_text):
+                payload = delta
+            else:
+                is_snapshot = True
+
+        # Snapshots carry the media too, so rebuilding from one doesn't need older versions
+        media = None
+        if new_media is not None and (is_snapshot or new_media != old_media):
+            media = encryptor.encrypt(new_media)
+
+        versions.append(VersionData(connection_id=message.connection_id, message_id=message.message_id,
+                                    version=version, is_snapshot=is_snapshot, payload=encryptor.encrypt(payload),
+                                    media=media))
+
+        repo.versions.add_many(versions)
+        return version
+
+    @staticmethod
+    def rebuild(rows: typing.Iterable[VersionData], encryptor: TextEncryptor) -> list[Version]:
+        """Decodes versions ordered by version, deltas before the first snapshot are skipped"""
+        rows = list(rows)
+        payloads = encryptor.decrypt_many(r.payload for r in rows)
+        medias = encryptor.decrypt_many(r.media for r in rows)
+
+        versions = []
+        text = None
+        media = None
+        for row, payload, row_media in zip(rows, payloads, medias):
+            if row.is_snapshot:
+                text = payload
+                media = None
+            elif text is None:
+                continue
+            else:
+                text = apply_delta(text, json.loads(payload))
+
+            if row_media is not None:
+                media = row_media
+            versions.append(Version(version=row.version, text=text, media=media, created_at=row.created_at))
+
+        return versions
+
+    async def chain(self, repo: Repo, connection_id: bytes, message_id: int,
+                    encryptor: TextEncryptor) -> list[Version]:
+        """Every stored version of a message, oldest first"""
+        return self.rebuild(await repo.versions.chain(connection_id, message_id), encryptor)
+
+    async def chains(self, repo: Repo, connection_id: bytes, message_ids: typing.Iterable[int],
+                     encryptor: TextEncryptor) -> dict[int, list[Version]]:
+        """Every stored version of many messages by message id, read with one query"""
+        rows = await repo.versions.chains(connection_id, message_ids)
+        return {message_id: self.rebuild(chain, encryptor) for message_id, chain in rows.items()}
+
+    async def get(self, repo: Repo, connection_id: bytes, message_id: int, version: int,
+                  encryptor: TextEncryptor) -> typing.Optional[Version]:
+        """One version of a message, rebuilt from the closest snapshot"""
+        versions = self.rebuild(await repo.versions.chain(connection_id, message_id, version), encryptor)
+        return versions[-1] if versions and versions[-1].version == version else None
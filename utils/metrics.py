@@ -0,0 +1,223 @@
+import abc
+import bisect
+import contextlib
+import math
+import re
+import time
+import typing
+
+from aiohttp import web
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _labels(labels: dict[str, typing.Any]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric(abc.ABC):
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+
+    @abc.abstractmethod
+    def samples(self) -> typing.Iterator[tuple[str, Labels, float]]:
+        pass
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(f"{name}{_format_labels(labels)} {_format_value(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str) -> None:
+        super().__init__(name, documentation)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _labels(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_labels(labels), 0)
+
+    def samples(self) -> typing.Iterator[tuple[str, Labels, float]]:
+        for labels, value in self._values.items():
+            yield f"{self.name}_total", labels, value
+
+
+class CallbackCounter(Metric):
+    """Counter whose total is read from `callback`, for values counted by the objects themselves"""
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, callback: typing.Callable[[], float]) -> None:
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def samples(self) -> typing.Iterator[tuple[str, Labels, float]]:
+        yield f"{self.name}_total", (), self.callback()
+
+
+class Gauge(Metric):
+    """Gauge whose value is read from `callback` every time the metrics are collected"""
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback: typing.Callable[[], float]) -> None:
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def samples(self) -> typing.Iterator[tuple[str, Labels, float]]:
+        yield self.name, (), self.callback()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: typing.Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+
+        # Labels -> (counts per bucket, the last one is +Inf), sum
+        self._values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels(labels)
+        item = self._values.get(key)
+        if item is None:
+            item = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+
+        item[0][bisect.bisect_left(self.buckets, value)] += 1
+        item[1][0] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes the seconds spent in the block, `labels` may be changed inside it"""
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        item = self._values.get(_labels(labels))
+        return sum(item[0]) if item is not None else 0
+
+    def samples(self) -> typing.Iterator[tuple[str, Labels, float]]:
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", labels + (("le", _format_value(bound)),), cumulative
+            yield f"{self.name}_sum", labels, total[0]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self.register(Counter(name, documentation))
+
+    def callback_counter(self, name: str, documentation: str, callback: typing.Callable[[], float]) -> CallbackCounter:
+        """Registers a counter read from `callback`, the value must only grow until the process restarts"""
+        return self.register(CallbackCounter(name, documentation, callback))
+
+    def gauge(self, name: str, documentation: str, callback: typing.Callable[[], float]) -> Gauge:
+        """Registers a gauge, a gauge with the same name is replaced"""
+        return self.register(Gauge(name, documentation, callback))
+
+    def histogram(self, name: str, documentation: str, buckets: typing.Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, buckets))
+
+    def render(self) -> str:
+        """Metrics in the Prometheus text exposition format"""
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+registry = Registry()
+
+UPDATES = registry.counter("bot_updates", "Updates handled by type and result")
+UPDATE_LATENCY = registry.histogram("bot_update_latency_seconds", "Time to handle an update, filters included")
+HANDLER_LATENCY = registry.histogram("bot_handler_latency_seconds", "Time spent in handlers by router and handler")
+QUERIES = registry.counter("bot_db_queries", "Executed SQL statements by statement kind and table")
+QUERY_ERRORS = registry.counter("bot_db_query_errors", "Failed SQL statements by statement kind and table")
+QUERY_LATENCY = registry.histogram("bot_db_query_latency_seconds", "SQL statement execution time by kind and table")
+API_REQUESTS = registry.counter("bot_api_requests", "Bot API requests by method and result")
+API_LATENCY = registry.histogram("bot_api_latency_seconds", "Bot API request time by method, rate limiting excluded")
+
+_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+[`\"]?(\w+)", re.IGNORECASE)
+
+
+def statement_labels(statement: str) -> dict[str, str]:
+    """`SELECT messages.id FROM messages WHERE ...` -> {"statement": "select", "table": "messages"}"""
+    words = statement.split(None, 1)
+    table = _TABLE.search(statement)
+    return dict(statement=words[0].lower() if words else "other", table=table.group(1).lower() if table else "")
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """Times and counts every statement executed by `engine`"""
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        labels = statement_labels(statement)
+        QUERIES.inc(**labels)
+        QUERY_LATENCY.observe(elapsed, **labels)
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def on_error(context) -> None:
+        starts = context.connection.info.get("query_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
+        QUERY_ERRORS.inc(**statement_labels(context.statement or ""))
+
+
+async def start_server(host: str, port: int, path: str = "/metrics") -> web.AppRunner:
+    """Serves the metrics of `registry` over HTTP, the runner has to be cleaned up by the caller"""
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(body=registry.render().encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get(path, handle)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    return runner
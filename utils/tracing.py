@@ -0,0 +1,171 @@
+import asyncio
+import contextlib
+import contextvars
+import datetime
+import json
+import logging
+import time
+import typing
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+SQL = "sql"
+CRYPTO = "crypto"
+API = "api"
+
+STATEMENT_LENGTH = 300  # Longer SQL statements are cut in dumps
+
+
+class Trace:
+    """
+    Work done while handling one update.
+
+    Calls are always counted and timed per kind, every call is only kept as a span when the update was sampled.
+    """
+
+    def __init__(self, update_id: int, update_type: str, sampled: bool, max_spans: int = 200) -> None:
+        self.update_id = update_id
+        self.update_type = update_type
+        self.sampled = sampled
+        self.max_spans = max_spans
+
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.finished = False
+
+        self.counts: dict[str, int] = {SQL: 0, CRYPTO: 0, API: 0}
+        self.seconds: dict[str, float] = {SQL: 0.0, CRYPTO: 0.0, API: 0.0}
+        self.spans: list[dict[str, typing.Any]] = []
+        self.dropped_spans = 0
+
+    def record(self, kind: str, name: str, start: float, elapsed: float) -> None:
+        # Background tasks started by the update inherit its context and may outlive it
+        if self.finished:
+            return
+
+        self.counts[kind] += 1
+        self.seconds[kind] += elapsed
+
+        if not self.sampled:
+            return
+        if len(self.spans) >= self.max_spans:
+            self.dropped_spans += 1
+            return
+
+        self.spans.append(dict(kind=kind, name=name, at_ms=round((start - self.started) * 1000, 3),
+                               ms=round(elapsed * 1000, 3)))
+
+    def finish(self) -> None:
+        self.duration = time.perf_counter() - self.started
+        self.finished = True
+
+    def to_dict(self) -> dict[str, typing.Any]:
+        return dict(
+            time=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            update_id=self.update_id,
+            type=self.update_type,
+            ms=round(self.duration * 1000, 3),
+            queries=self.counts[SQL],
+            crypto_calls=self.counts[CRYPTO],
+            api_calls=self.counts[API],
+            sql_ms=round(self.seconds[SQL] * 1000, 3),
+            crypto_ms=round(self.seconds[CRYPTO] * 1000, 3),
+            api_ms=round(self.seconds[API] * 1000, 3),
+            sampled=self.sampled,
+            spans=self.spans,
+            dropped_spans=self.dropped_spans,
+        )
+
+
+_trace: contextvars.ContextVar[typing.Optional[Trace]] = contextvars.ContextVar("trace", default=None)
+
+
+def current_trace() -> typing.Optional[Trace]:
+    return _trace.get()
+
+
+@contextlib.contextmanager
+def activate(trace: Trace):
+    """Makes `trace` the trace of the current context"""
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+        trace.finish()
+
+
+@contextlib.contextmanager
+def span(kind: str, name: str):
+    """Records the block into the trace of the current context, does nothing outside of a trace"""
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.record(kind, name, start, time.perf_counter() - start)
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """Records every statement executed by `engine` into the trace of the update it was executed for"""
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        if _trace.get() is not None:
+            conn.info.setdefault("trace_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        trace = _trace.get()
+        starts = conn.info.get("trace_start")
+        if trace is None or not starts:
+            return
+
+        start = starts.pop()
+        name = " ".join(statement.split())[:STATEMENT_LENGTH]
+        if executemany:
+            name = f"{name} [x{len(parameters)}]"
+        trace.record(SQL, name, start, time.perf_counter() - start)
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def on_error(context) -> None:
+        starts = context.connection.info.get("trace_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+
+class SlowLog:
+    """Appends traces of slow updates to a JSONL file, the file is written in a worker thread"""
+
+    def __init__(self, path: str, slow_ms: float = 500, slow_queries: int = 10) -> None:
+        self.path = path
+        self.slow_ms = slow_ms
+        self.slow_queries = slow_queries
+
+        self.dumped = 0
+        self._lock = asyncio.Lock()  # Lines of concurrent dumps are not interleaved
+
+    def is_slow(self, trace: Trace) -> bool:
+        return trace.duration * 1000 >= self.slow_ms or trace.counts[SQL] >= self.slow_queries
+
+    def _append(self, line: str) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+    async def write(self, trace: Trace) -> None:
+        line = json.dumps(trace.to_dict(), ensure_ascii=False) + "\n"
+        try:
+            async with self._lock:
+                await asyncio.to_thread(self._append, line)
+        except OSError as e:
+            logging.error(f"Failed to write the slow update log {self.path}: {e}")
+            return
+
+        self.dumped += 1
+        logging.warning(f"Slow update id={trace.update_id} ({trace.update_type}): {trace.duration * 1000:.1f} ms, "
+                        f"{trace.counts[SQL]} queries, {trace.counts[API]} requests")
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import typing
+
+import aiohttp
+from aiogram.client.telegram import PRODUCTION
+
+from utils.encryptor import get_text_hash
+
+BUSINESS_UPDATES = ("business_message", "edited_business_message", "deleted_business_messages")
+
+
+def shard_key(update: dict) -> str:
+    """Updates with the same key are always handled by the same worker"""
+    for field in BUSINESS_UPDATES:
+        if field in update:
+            return update[field]["business_connection_id"]
+
+    if "business_connection" in update:
+        return update["business_connection"]["id"]
+
+    for event in update.values():
+        if isinstance(event, dict):
+            if "chat" in event:
+                return str(event["chat"]["id"])
+            if "from" in event:
+                return str(event["from"]["id"])
+
+    return str(update["update_id"])
+
+
+def shard_of(update: dict, workers: int) -> int:
+    return int.from_bytes(get_text_hash(shard_key(update))[:8], "big") % workers
+
+
+def worker_main(index: int, workers: int, updates: multiprocessing.Queue, health: multiprocessing.Queue,
+                health_interval: int) -> None:
+    # Workers are stopped by the supervisor, not by Ctrl+C sent to the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_run_worker(index, workers, updates, health, health_interval))
+
+
+async def _run_worker(index: int, workers: int, updates: multiprocessing.Queue, health: multiprocessing.Queue,
+                      health_interval: int) -> None:
+    import main  # Every worker builds its own dispatcher, database pool and caches
+
+    loop = asyncio.get_running_loop()
+    bot = main.create_bot(rate_share=1 / workers)
+    processed = 0
+
+    async def report() -> None:
+        while True:
+            health.put(dict(worker=index, pid=os.getpid(), processed=processed, in_flight=main.ordering.depth,
+                            time=time.time()))
+            await asyncio.sleep(health_interval)
+
+    # Only one worker prunes old messages and converts legacy payloads
+    await main.dp.emit_startup(bot=bot, dispatcher=main.dp, run_pruner=index == 0, worker=index)
+    reporter = asyncio.create_task(report())
+
+    try:
+        while True:
+            update = await loop.run_in_executor(None, updates.get)
+            if update is None:
+                break
+
+            # Only queues the update, waits when the queues of the worker are full
+            await main.dp.feed_raw_update(bot, update)
+            processed += 1
+    finally:
+        reporter.cancel()
+
+        await main.dp.emit_shutdown(bot=bot, dispatcher=main.dp)
+        await bot.session.close()
+        await main.db.close()
+
+        logging.info(f"Worker {index} stopped after {processed} updates")
+
+
+class Supervisor:
+    """
+    Polls updates and routes them to worker processes by business connection.
+
+    Updates of one connection always go to the same worker, so they are handled in order
+    while all cores are used. Workers report their health periodically, dead workers are restarted.
+    """
+
+    def __init__(self, token: str, workers: int, health_interval: int = 10,
+                 allowed_updates: typing.Optional[list[str]] = None, polling_timeout: int = 30) -> None:
+        self.token = token
+        self.workers = workers
+        self.health_interval = health_interval
+        self.allowed_updates = allowed_updates
+        self.polling_timeout = polling_timeout
+
+        self.health: dict[int, dict] = {}
+
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue() for _ in range(workers)]
+        self._health_queue = self._context.Queue()
+        self._processes: list[typing.Optional[multiprocessing.Process]] = [None] * workers
+        self._started: list[float] = [0.0] * workers
+
+    def _start_worker(self, index: int) -> None:
+        process = self._context.Process(target=worker_main,
+                                        args=(index, self.workers, self._queues[index], self._health_queue,
+                                              self.health_interval),
+                                        name=f"worker-{index}")
+        process.start()
+        self._processes[index] = process
+        self._started[index] = time.time()
+        logging.info(f"Worker {index} started with pid {process.pid}")
+
+    async def _watch(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            await asyncio.sleep(self.health_interval)
+
+            while not self._health_queue.empty():
+                report = await loop.run_in_executor(None, self._health_queue.get)
+                self.health[report["worker"]] = report
+
+            for index, process in enumerate(self._processes):
+                if not process.is_alive():
+                    logging.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                    self._start_worker(index)
+                    continue
+
+                report = self.health.get(index)
+                last_seen = max(self._started[index], report["time"] if report is not None else 0)
+                if time.time() - last_seen > self.health_interval * 3:
+                    logging.warning(f"Worker {index} has not reported for {self.health_interval * 3}s")
+
+    async def _poll(self) -> None:
+        url = PRODUCTION.api_url(token=self.token, method="getUpdates")
+        offset = None
+
+        async with aiohttp.ClientSession() as session:
+            while True:
+                params = dict(timeout=self.polling_timeout)
+                if self.allowed_updates is not None:
+                    params["allowed_updates"] = self.allowed_updates
+                if offset is not None:
+                    params["offset"] = offset
+
+                try:
+                    async with session.post(url, json=params,
+                                            timeout=aiohttp.ClientTimeout(total=self.polling_timeout + 10)) as r:
+                        response = await r.json()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logging.warning(f"Failed to fetch updates: {e}")
+                    await asyncio.sleep(1)
+                    continue
+
+                if not response.get("ok"):
+                    logging.error(f"Failed to fetch updates: {response.get('description')}")
+                    await asyncio.sleep(1)
+                    continue
+
+                for update in response["result"]:
+                    self._queues[shard_of(update, self.workers)].put(update)
+                    offset = update["update_id"] + 1
+
+    async def run(self) -> None:
+        for index in range(self.workers):
+            self._start_worker(index)
+
+        watcher = asyncio.create_task(self._watch())
+        try:
+            await self._poll()
+        finally:
+            watcher.cancel()
+            await self.stop()
+
+    async def stop(self, timeout: float = 30) -> None:
+        logging.info("Stopping workers")
+        for queue in self._queues:
+            queue.put(None)
+
+        loop = asyncio.get_running_loop()
+        for index, process in enumerate(self._processes):
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logging.warning(f"Worker {index} did not stop in {timeout}s, terminating")
+                process.terminate()